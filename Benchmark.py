@@ -0,0 +1,213 @@
+import argparse, json, os, platform, time
+import numpy as np
+import cv2
+from CustomPSO import custom_pso
+from ImageUtility import apply_transformations, apply_transformations_batch, image_Points_Intensities, lb, ub
+from OptimalTransport import POT_Parameterized, SOLVERS
+from ParticleSwarm import objective_function_batch, optimal_sample_transform
+from IO import suppress_stdout
+
+# Benchmarks run on procedurally generated glyphs, drawn with OpenCV's
+# built in Hershey vector fonts, so no fonts download or MNIST is needed
+
+HERSHEY_FONTS = [cv2.FONT_HERSHEY_SIMPLEX, cv2.FONT_HERSHEY_DUPLEX, cv2.FONT_HERSHEY_COMPLEX,
+                 cv2.FONT_HERSHEY_TRIPLEX, cv2.FONT_HERSHEY_PLAIN, cv2.FONT_HERSHEY_SCRIPT_SIMPLEX]
+
+BASELINE = 'benchmark_baseline.json'
+
+def synthetic_glyph(character, size=30, font=cv2.FONT_HERSHEY_SIMPLEX, thickness=2):
+    """
+    Draws a character centered in a size x size grayscale image,
+    white on black like the images read_font produces
+
+    Args:
+        character (string): character to draw
+        size (int): resolution of the image
+        font (int): cv2 Hershey font face
+        thickness (int): stroke thickness
+
+    Returns:
+        image (np array): uint8 image of the character
+    """
+    image = np.zeros((size, size), dtype=np.uint8)
+    scale = size / 30
+    (width, height), baseline = cv2.getTextSize(character, font, scale, thickness)
+    origin = ((size - width) // 2, (size + height) // 2)
+    cv2.putText(image, character, origin, font, scale, 255, thickness, cv2.LINE_AA)
+    return image
+
+def synthetic_set(rng, characters='0123456789', size=30):
+    """
+    A comparison set of every character in a random font and stroke thickness
+
+    Returns:
+        images (list of images): one glyph per character
+    """
+    font = HERSHEY_FONTS[rng.integers(len(HERSHEY_FONTS))]
+    thickness = int(rng.integers(1, 4))
+    return [synthetic_glyph(character, size, font, thickness) for character in characters]
+
+def measure(func, repeat=5, number=1):
+    """
+    Times a function the way timeit does, keeping the best of repeat runs
+
+    Returns:
+        seconds (number): best time of a single call
+    """
+    best = float('infinity')
+    for r in range(repeat):
+        start = time.perf_counter()
+        for n in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+def micro_benchmarks(seed=0, size=30, swarmsize=40):
+    """
+    Times the hot path stages on a fixed synthetic sample
+
+    Returns:
+        results (dict): seconds per call of each stage
+    """
+    rng = np.random.default_rng(seed)
+    comp_set = synthetic_set(rng, size=size)
+    comp_image = comp_set[3]
+    x = rng.uniform(lb, ub)
+    X = rng.uniform(lb, ub, (swarmsize, len(lb)))
+    sample_image = apply_transformations(x, comp_image)
+    a, SA = image_Points_Intensities(comp_image)
+    b, DB = image_Points_Intensities(sample_image)
+
+    def pso_search(maxiter):
+        with suppress_stdout():
+            custom_pso(objective_function_batch, lb, ub, args=((a, SA), sample_image), swarmsize=swarmsize,
+                       maxiter=maxiter, minstep=0, minfunc=0)
+
+    return {
+        'apply_transformations': measure(lambda: apply_transformations(x, sample_image), number=100),
+        'apply_transformations_batch': measure(lambda: apply_transformations_batch(X, sample_image), number=10),
+        'image_Points_Intensities': measure(lambda: image_Points_Intensities(sample_image), number=100),
+        'POT_Parameterized': measure(lambda: POT_Parameterized(a, b, SA, DB, sample_image.shape), number=10),
+        'POT_Parameterized_sinkhorn': measure(lambda: POT_Parameterized(a, b, SA, DB, sample_image.shape, 'sinkhorn'), 
+                                              number=10),
+        'objective_function_batch': measure(lambda: objective_function_batch(X, (a, SA), sample_image)),
+        'objective_function_batch_sinkhorn': measure(lambda: objective_function_batch(X, (a, SA), sample_image, 
+                                                                                      solver='sinkhorn')),
+        # a search always evaluates the initial swarm, so a single iteration
+        # is the difference between searches of two and one iterations
+        'custom_pso_iteration': max(0, measure(lambda: pso_search(2)) - measure(lambda: pso_search(1))),
+        'support_size': int(len(a) + len(b)),
+    }
+
+def macro_benchmarks(options, samples=10, seed=0, size=30):
+    """
+    Classifies randomly transformed synthetic glyphs end to end
+
+    Args:
+        options (dict): optimal_sample_transform options, comp_set and
+            sample_image are filled in per sample
+        samples (int): number of samples to classify
+
+    Returns:
+        results (dict): mean seconds per classification and accuracy
+    """
+    rng = np.random.default_rng(seed)
+    np.random.seed(seed)
+    correct = 0
+    total_time = 0
+    for i in range(samples):
+        comp_set = synthetic_set(rng, size=size)
+        answer = int(rng.integers(len(comp_set)))
+        x = rng.uniform(lb, ub)
+        sample_image = apply_transformations(x, comp_set[answer])
+        start = time.perf_counter()
+        with suppress_stdout():
+            best_images, min_answer, xopt = optimal_sample_transform(dict(options, comp_set=comp_set,
+                                                                          sample_image=sample_image))
+        total_time += time.perf_counter() - start
+        correct += int(min_answer == answer)
+    return {'classification_time': total_time / samples, 'accuracy': correct / samples}
+
+def compare(results, baseline, time_tolerance=1.2, accuracy_tolerance=0.05):
+    """
+    Compares benchmark results against a baseline
+
+    Args:
+        results (dict): results of run_benchmarks
+        baseline (dict): stored results of an earlier run_benchmarks
+        time_tolerance (number): slowdown ratio above which a time regressed
+        accuracy_tolerance (number): accuracy drop above which accuracy regressed
+
+    Returns:
+        regressions (list of string): description of every regression
+    """
+    regressions = []
+    for level in ('micro', 'macro'):
+        for name, value in results[level].items():
+            if name not in baseline.get(level, {}) or name == 'support_size':
+                continue
+            old = baseline[level][name]
+            if name == 'accuracy':
+                if old - value > accuracy_tolerance:
+                    regressions.append('{} dropped from {:.3f} to {:.3f}'.format(name, old, value))
+            elif old > 0 and value / old > time_tolerance:
+                regressions.append('{} slowed {:.2f}x ({:.6f}s -> {:.6f}s)'.format(name, value / old, old, value))
+            print('{:<30} {:>12.6f} {:>12.6f} {:>8.2f}x'.format(name, old, value, value / old if old else 0))
+    return regressions
+
+def run_benchmarks(options, samples=10, seed=0):
+    """
+    Runs the micro and macro benchmarks
+
+    Returns:
+        results (dict): micro and macro results along with the machine they ran on
+    """
+    return {
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(), 'python': platform.python_version()},
+        'micro': micro_benchmarks(seed),
+        'macro': macro_benchmarks(options, samples, seed),
+    }
+
+BENCHMARK_OPTIONS = {
+    'func': objective_function_batch,
+    'lb': lb,
+    'ub': ub,
+    'swarmsize': 20,
+    'w': 1.0,
+    'c1': 0.5,
+    'c2': 0.5,
+    'maxiter': 20,
+    'minstep': 1e-4,
+    'minfunc': 1e-5,
+    'debug': False,
+    'inertia_decay': 0.96
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TIPR performance benchmarks')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to write the results')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline to compare the results with')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--samples', type=int, default=10, help='samples classified by the macro benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tolerance', type=float, default=1.2, help='allowed slowdown ratio')
+    parser.add_argument('--solver', default='emd', choices=SOLVERS, help='OT solver of the macro benchmark')
+    arguments = parser.parse_args()
+
+    results = run_benchmarks(dict(BENCHMARK_OPTIONS, solver=arguments.solver), arguments.samples, arguments.seed)
+    with open(arguments.output, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(json.dumps(results, indent=4))
+
+    if arguments.save_baseline:
+        with open(arguments.baseline, 'w') as f:
+            json.dump(results, f, indent=4)
+        print('saved baseline to {}'.format(arguments.baseline))
+    elif os.path.isfile(arguments.baseline):
+        with open(arguments.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), arguments.tolerance)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        if regressions:
+            raise SystemExit(1)
+        print('no regressions against {}'.format(arguments.baseline))
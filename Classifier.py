@@ -0,0 +1,135 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from ImageUtility import image_Points_Intensities, downsample_image
+from OptimalTransport import DualPotentials, WARM_STARTED_SOLVERS, grid_cost_table
+from ParticleSwarm import (sample_argument, budget_arguments, fit_candidate, submit_candidates, candidate_result,
+                           race_candidates, fit_candidates_multi_swarm, select_candidate)
+import Instrumentation
+
+def warm_cost_tables(shapes):
+    """
+    Builds the grid cost tables of the given image shapes in this process,
+    used as the initializer of a classifier's worker processes
+
+    Args:
+        shapes (list of tuple): image shapes searched by the classifier
+    """
+    for shape in shapes:
+        grid_cost_table(shape)
+
+class TIPRClassifier:
+    """
+    Classifies many samples against the same comparison set
+    Everything that only depends on the comparison set is done once in fit:
+    the extract of every glyph, the grid cost tables of every image shape
+    searched and, for the WARM_STARTED_SOLVERS, a warm start store per glyph that
+    carries its dual potentials from one sample to the next. With workers the
+    pool is kept for the classifier's lifetime and classify_batch submits
+    every (sample, candidate) pair at once so the pool stays busy across
+    samples rather than waiting on the slowest candidate of each. Pooled fits
+    of the same glyph run concurrently, so they do not use the warm start
+    stores and every sinkhorn solve starts cold
+
+    Args:
+        options (dict): optimal_sample_transform options, comp_set and
+            sample_image are not needed
+
+    Usage:
+        with TIPRClassifier(options).fit(comp_set) as classifier:
+            classifications = classifier.classify_batch(samples)
+    """
+    def __init__(self, options):
+        self.options = {key: value for key, value in options.items() if key not in ('comp_set', 'sample_image')}
+        self.comp_set = None
+        self.extracts = None
+        self.potentials = None
+        self.executor = None
+
+    def fit(self, comp_set):
+        """
+        Precomputes the per glyph state of a comparison set
+
+        Args:
+            comp_set (list of images): original forms
+
+        Returns:
+            self (TIPRClassifier): the fitted classifier
+        """
+        self.close()
+        options = self.options
+        self.comp_set = list(comp_set)
+        self.extracts = [image_Points_Intensities(comp_image, **budget_arguments(options)) for comp_image in self.comp_set]
+        solver = options.get('solver', 'emd')
+        self.potentials = [DualPotentials() if solver in WARM_STARTED_SOLVERS else None for comp_image in self.comp_set]
+        shapes = sorted({comp_image.shape[:2] for comp_image in self.comp_set})
+        shapes += [downsample_image(np.zeros(shape, dtype=np.uint8), factor).shape
+                   for factor in options.get('pyramid') or [] for shape in shapes]
+        warm_cost_tables(shapes)
+        if options.get('executor') is None and options.get('workers', 1) > 1:
+            self.executor = ProcessPoolExecutor(max_workers=options['workers'], initializer=warm_cost_tables,
+                                                initargs=(shapes,))
+        return self
+
+    def classify(self, sample_image, log=False):
+        """
+        Classifies a single sample
+
+        Args:
+            sample_image (image): variation
+            log (boolean): also return a log of the search (Default: False)
+
+        Returns:
+            optimal_sample_transform return values
+        """
+        return self.classify_batch([sample_image], log)[0]
+
+    def classify_batch(self, samples, log=False):
+        """
+        Classifies every sample against the fitted comparison set
+
+        Args:
+            samples (list of images): variations
+            log (boolean): also return a log of each search (Default: False)
+
+        Returns:
+            classifications (list): optimal_sample_transform return values
+                per sample
+        """
+        assert self.comp_set is not None, 'fit must be called before classifying'
+        options = [dict(self.options, comp_set=self.comp_set, sample_image=sample_image) for sample_image in samples]
+        arguments = [sample_argument(self.options['func'], sample_image, **budget_arguments(self.options))
+                     for sample_image in samples]
+        executor = self.options.get('executor') or self.executor
+        started = Instrumentation.start()
+        if self.options.get('race_rung'):
+            results = [race_candidates(sample_options, sample) for sample_options, sample in zip(options, arguments)]
+        elif self.options.get('engine') == 'multi_swarm':
+            results = [fit_candidates_multi_swarm(sample_options, sample, self.extracts, self.potentials)
+                       for sample_options, sample in zip(options, arguments)]
+        elif executor is not None:
+            futures = [submit_candidates(executor, sample_options, sample, self.extracts)
+                       for sample_options, sample in zip(options, arguments)]
+            results = [[candidate_result(future) for future in sample_futures] for sample_futures in futures]
+        else:
+            results = [[fit_candidate(sample_options, comp_image, sample, comp_extract=extract, potentials=potentials)
+                        for comp_image, extract, potentials in zip(self.comp_set, self.extracts, self.potentials)]
+                       for sample_options, sample in zip(options, arguments)]
+        classifications = [select_candidate(sample_options, sample, sample_results, log)
+                           for sample_options, sample, sample_results in zip(options, arguments, results)]
+        Instrumentation.count('classifications', len(samples))
+        Instrumentation.stop('classify_batch', started)
+        return classifications
+
+    def close(self):
+        """
+        Shuts down the classifier's worker processes, if it has any
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
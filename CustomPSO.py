@@ -4,10 +4,14 @@ from pyswarms.backend.topology import Star, Ring, VonNeumann, Random, Pyramid
 from pyswarms.backend.handlers import BoundaryHandler, VelocityHandler
 from ImageUtility import lb, ub
 from matplotlib import pyplot as plt
+from collections import OrderedDict
+from scipy.spatial import cKDTree
+import Instrumentation
 
-def custom_pso(func, lb, ub, args=(), swarmsize=100, 
+def custom_pso(func, lb, ub, args=(), kwargs={}, swarmsize=100, 
                 w=0.5, c1=0.5, c2=0.5, maxiter=100, 
-                minstep=1e-8, minfunc=1e-8, debug=False, inertia_decay=1, inital_position=None):
+                minstep=1e-8, minfunc=1e-8, debug=False, inertia_decay=1, inital_position=None,
+                rescore_func=None, rescore_k=1, rescore_kwargs={}, prune=False, patience=None, shrink=1, min_swarmsize=5):
     """
     Perform a particle swarm optimization (PSO)
     Stylistically similar to pyswarm.pso, but with a few key differences:
@@ -29,6 +33,9 @@ def custom_pso(func, lb, ub, args=(), swarmsize=100,
     args : tuple
         Additional arguments passed to objective and constraint functions
         (Default: empty tuple)
+    kwargs : dict
+        Additional keyword arguments passed to objective function
+        (Default: empty dict)
     swarmsize : int
         The number of particles in the swarm (Default: 100)
     w : inertia weight
@@ -53,12 +60,82 @@ def custom_pso(func, lb, ub, args=(), swarmsize=100,
     intertia_decay : scalar
         The rate at which the inertia weight decreases by proportion scalar*100%
         (Default: 1)
+    rescore_func : function
+        Optional exact objective for when func is a cheap approximation, the
+        best rescore_k personal bests are re-evaluated with it (given the same
+        args) once the search stops and the best of them is returned
+        (Default: None)
+    rescore_k : int
+        The number of personal bests re-evaluated by rescore_func (Default: 1)
+    rescore_kwargs : dict
+        Keyword arguments passed to rescore_func instead of kwargs
+        (Default: empty dict)
+    prune : boolean
+        If True, func is also given every particle's personal best cost as
+        the keyword pbest_cost and may return a lower bound in place of any
+        cost above it, such a particle's personal best is unchanged either
+        way so the personal and swarm bests stay exact (Default: False)
+    patience : int
+        The number of consecutive iterations without any improvement of the
+        swarm's best objective value before the search terminates
+        (Default: None, no limit)
+    shrink : scalar
+        After every iteration without improvement the swarm keeps only this
+        proportion of its particles, those with the best personal bests, so
+        a converging swarm costs fewer objective evaluations (Default: 1)
+    min_swarmsize : int
+        The number of particles the swarm never shrinks below (Default: 5)
     Returns
     =======
     swarm.best_pos : array
         The best position found during the search
     swarm.best_cost : scalar
         The objective value at ``swarm.best_pos``
+    collisions : int
+        The number of particle collisions that caused a respawn
+    i : int
+        The index of the final iteration
+    """
+    return run_search(pso_search(func, lb, ub, args, kwargs, swarmsize, w, c1, c2, maxiter,
+                                 minstep, minfunc, debug, inertia_decay, inital_position,
+                                 rescore_func, rescore_k, rescore_kwargs, prune, patience, shrink, min_swarmsize))
+
+def run_search(search):
+    """
+    Advances a pso_search generator until a stopping criterion is met
+
+    Parameters
+    ==========
+    search : generator
+        A search created by pso_search
+
+    Returns
+    =======
+    The return values of custom_pso
+    """
+    while True:
+        try:
+            next(search)
+        except StopIteration as stop:
+            return stop.value
+
+def pso_search(func, lb, ub, args=(), kwargs={}, swarmsize=100, 
+               w=0.5, c1=0.5, c2=0.5, maxiter=100, 
+               minstep=1e-8, minfunc=1e-8, debug=False, inertia_decay=1, inital_position=None,
+               rescore_func=None, rescore_k=1, rescore_kwargs={}, prune=False, patience=None, shrink=1, min_swarmsize=5):
+    """
+    Generator form of custom_pso taking the same parameters
+    The search yields after every iteration so that a caller can advance
+    several searches in rounds, and returns once a stopping criterion is met
+
+    Yields
+    ======
+    (swarm.best_pos, swarm.best_cost, collisions, i) : tuple
+        The state of the search after iteration i
+    
+    Returns
+    =======
+    The return values of custom_pso
     """
     
     # Check for bound shapes
@@ -69,7 +146,9 @@ def custom_pso(func, lb, ub, args=(), swarmsize=100,
     assert np.all(ub>lb), 'All upper-bound values must be greater than lower-bound values'
 
     # Initialize objective function
-    obj = lambda x: func(x, *args)
+    obj = lambda x, **bound: func(x, *args, **kwargs, **bound)
+    cache = memoized_objective(func)
+    cache_misses = cache.misses if cache is not None else 0
     
     # get dimensions
     dimensions = len(ub)
@@ -94,7 +173,10 @@ def custom_pso(func, lb, ub, args=(), swarmsize=100,
     if inital_position is not None:
         swarm.position = inital_position
     # Initialize the swarm's positions and costs
+    started = Instrumentation.start()
     swarm.current_cost = P.compute_objective_function(swarm, obj)
+    Instrumentation.stop('objective', started)
+    Instrumentation.count('objective_evaluations', swarmsize)
     swarm.pbest_cost = np.inf * np.ones(swarmsize)
     swarm.pbest_pos, swarm.pbest_cost = P.compute_pbest(swarm)
     swarm.best_pos, swarm.best_cost = topology.compute_gbest(swarm)
@@ -115,30 +197,47 @@ def custom_pso(func, lb, ub, args=(), swarmsize=100,
     # Velocity handler will decrease the particle's velocity as the search progresses
     vh = VelocityHandler(strategy="unmodified")
     
+    def finish():
+        Instrumentation.observe('iterations_to_convergence', i + 1)
+        # a cached objective is only called for its misses
+        calls = evaluations if cache is None else cache.misses - cache_misses
+        # evaluations the full swarm would have made over every iteration
+        saved = swarmsize * (maxiter + 1) - calls
+        Instrumentation.count('evaluations_saved', saved)
+        print('Objective evaluations {:} of {:}, saved {:}'.format(calls, swarmsize * (maxiter + 1), saved))
+        if rescore_func is None:
+            return swarm.best_pos, swarm.best_cost, collisions, i
+        # re-evaluate the leading personal bests with the exact objective
+        top = np.argsort(swarm.pbest_cost)[:rescore_k]
+        costs = rescore_func(swarm.pbest_pos[top], *args, **rescore_kwargs)
+        Instrumentation.count('rescore_evaluations', len(top))
+        best = np.argmin(costs)
+        return swarm.pbest_pos[top[best]], costs[best], collisions, i
+    
     # Iterate until termination criterion met
     collisions = 0
+    evaluations = swarmsize
+    # iterations since the swarm's best objective value last improved
+    stagnant = 0
     for i in range(maxiter):
 
         # inertia weight decreases compoundingly
         swarm.options.update({'w': w * inertia_decay**i})
 
+        Instrumentation.count('pso_iterations')
+        started = Instrumentation.start()
         # Update the velocity and position of the swarm
         swarm.velocity = topology.compute_velocity(swarm, velocity_Clamp, vh, bounds)
         # Add some ratio matrix multiplied by velocity matrix
         swarm.position = topology.compute_position(swarm, bounds, bh)
         # if particles are too close to each other, move them apart
-        for k in range(swarmsize):
-            for j in range(swarmsize):
-                if k == j: continue
-                # take the distance between two particles
-                # if that distance is less than the minimum step, move the particle
-                # to a random position within the bounds
-                if np.sqrt(np.sum((swarm.position[k] - swarm.position[j])**2)) < minstep:
-                    collisions += 1
-                    # move the particle just outside the bounds
-                    # swarm.position[k] = swarm.position[k] + np.random.uniform(-1, 1, dimensions) * minstep
-                    swarm.position[k] = np.random.uniform(lb, ub, dimensions)
-                    swarm.velocity[k] = np.random.uniform(vlow, vhigh, dimensions)
+        # to a random position within the bounds
+        respawn = collision_respawns(swarm.position, minstep)
+        respawned = np.count_nonzero(respawn)
+        if respawned:
+            collisions += respawned
+            swarm.position[respawn] = np.random.uniform(lb, ub, (respawned, dimensions))
+            swarm.velocity[respawn] = np.random.uniform(vlow, vhigh, (respawned, dimensions))
 
         # Warning that the particles are not within the bounds and need to be clipped
         if not np.all(swarm.position <= ub): Warning('A particle moved out of bounds (upper): ' + str(swarm.position))
@@ -148,8 +247,16 @@ def custom_pso(func, lb, ub, args=(), swarmsize=100,
         if not np.all(swarm.velocity <= vhigh): Warning('A particle velocity was not within bounds (upper): ' + str(swarm.velocity))
         if not np.all(swarm.velocity >= vlow): Warning('A particle velocity was not within bounds (lower): ' + str(swarm.velocity))
 
+        Instrumentation.stop('pso_update', started)
+
         # update current cost of each particle by objective function
-        swarm.current_cost = P.compute_objective_function(swarm, obj)
+        started = Instrumentation.start()
+        bound = {'pbest_cost': swarm.pbest_cost} if prune else {}
+        swarm.current_cost = P.compute_objective_function(swarm, obj, **bound)
+        Instrumentation.stop('objective', started)
+        Instrumentation.count('objective_evaluations', len(swarm.position))
+        evaluations += len(swarm.position)
+        started = Instrumentation.start()
         
         # update particle best position and cost for each particle
         swarm.pbest_pos, swarm.pbest_cost = P.compute_pbest(swarm)
@@ -159,6 +266,7 @@ def custom_pso(func, lb, ub, args=(), swarmsize=100,
         best_position = swarm.best_pos
         # update swarm's best position and cost as dimension vector, cost
         swarm.best_pos, swarm.best_cost = topology.compute_gbest(swarm)
+        Instrumentation.stop('pso_best', started)
 
         # Calculate the step_size of swarm's best position if iteration > 0
         step_size = np.sqrt(np.sum((best_position - swarm.best_pos)**2))
@@ -174,17 +282,314 @@ def custom_pso(func, lb, ub, args=(), swarmsize=100,
             # Print the velocity matrix for each particle without scientific notation
             print('velocity: ' + str(np.array2string(swarm.velocity, formatter={'float_kind':lambda x: "%.4f" % x})))
             print('******************************')
+        
+        yield swarm.best_pos, swarm.best_cost, collisions, i
             
         # if swarm's best position is better than the best position of the swarm before updating
         if swarm.best_cost < best_cost:
             # print itteration number
             if np.abs(best_cost - swarm.best_cost) < minfunc:
                 print('Stopping search: Swarm best objective change less than {:} iterations {:} collisions {:}'.format(minfunc, i + 1, collisions))
-                return swarm.best_pos, swarm.best_cost, collisions, i
+                return finish()
         # If the stepsize of swarm's best position is too small then stop
         if step_size < minstep and step_size != 0:
             print('Stopping search: Swarm best position change less than {:} iterations {:} collisions {:}'.format(minstep, i + 1, collisions))
-            return swarm.best_pos, swarm.best_cost, collisions, i
+            return finish()
+        
+        stagnant = 0 if swarm.best_cost < best_cost else stagnant + 1
+        if patience is not None and stagnant >= patience:
+            print('Stopping search: Swarm best objective unchanged for {:} iterations {:} collisions {:}'.format(patience, i + 1, collisions))
+            return finish()
+        # a stagnating swarm drops the particles with the worst personal bests
+        if stagnant and shrink < 1 and len(swarm.position) > min_swarmsize:
+            keep = np.argsort(swarm.pbest_cost)[:max(min_swarmsize, int(np.ceil(shrink * len(swarm.position))))]
+            swarm.position = swarm.position[keep]
+            swarm.velocity = swarm.velocity[keep]
+            swarm.pbest_pos = swarm.pbest_pos[keep]
+            swarm.pbest_cost = swarm.pbest_cost[keep]
+            swarm.current_cost = swarm.current_cost[keep]
+            swarm.n_particles = len(keep)
+            # warm start stores are keyed by particle index
+            if hasattr(kwargs.get('potentials'), 'reindex'):
+                kwargs['potentials'].reindex(keep)
             
     print('Stopping search: maximum iterations reached --> {:} collisions {:}'.format(maxiter, collisions))
-    return swarm.best_pos, swarm.best_cost, collisions, i
\ No newline at end of file
+    return finish()
+
+def multi_swarm_pso(func, lb, ub, classes, args=(), kwargs={}, swarmsize=100, 
+                    w=0.5, c1=0.5, c2=0.5, maxiter=100, 
+                    minstep=1e-8, minfunc=1e-8, inertia_decay=1, inital_position=None,
+                    prune=False, patience=None):
+    """
+    Lean NumPy PSO running one swarm per class in lockstep
+    The swarms of every class live in (classes, particles, dimensions) arrays,
+    each iteration updates all of their velocities and positions in one
+    vectorized step and hands the positions of every swarm still searching
+    to the objective in a single call, so the per iteration overhead does
+    not grow with the number of classes. Each swarm follows custom_pso's
+    update (star topology, clamped velocity, random respawn of particles out
+    of bounds or within minstep of another) and stops on its own criteria
+
+    Parameters
+    ==========
+    func : function
+        The function to be minimized, called as
+        func(X, *args, classes=active, **kwargs) with X the positions of the
+        active swarms (len(active), particles, dimensions) and active their
+        class indices, returning costs of shape (len(active), particles)
+    lb : array
+        The lower bounds of the design variable(s)
+    ub : array
+        The upper bounds of the design variable(s)
+    classes : int
+        The number of swarms
+
+    Optional
+    ========
+    args, kwargs, swarmsize, w, c1, c2, maxiter, minstep, minfunc,
+    inertia_decay, prune, patience : see custom_pso
+    inital_position : array
+        Initial positions (classes, swarmsize, dimensions) (Default: None,
+        uniform within bounds)
+
+    Returns
+    =======
+    results : list
+        custom_pso return values of every class' swarm
+    """
+    lb = np.array(lb)
+    ub = np.array(ub)
+    assert lb.shape == ub.shape and np.all(ub > lb), 'All upper-bound values must be greater than lower-bound values'
+    dimensions = len(lb)
+    shape = (classes, swarmsize, dimensions)
+    vhigh = np.abs(ub - lb) / 5
+    
+    def evaluate(active, position, bound):
+        started = Instrumentation.start()
+        cost = np.asarray(func(position, *args, classes=active, **kwargs, **bound))
+        Instrumentation.stop('objective', started)
+        Instrumentation.count('objective_evaluations', cost.size)
+        return cost
+    
+    position = np.random.uniform(lb, ub, shape) if inital_position is None else np.array(inital_position, dtype=np.float64)
+    velocity = np.random.uniform(-vhigh, vhigh, shape)
+    everyone = np.arange(classes)
+    pbest_pos = position.copy()
+    pbest_cost = evaluate(everyone, position, {})
+    best = np.argmin(pbest_cost, axis=1)
+    best_pos = pbest_pos[everyone, best]
+    best_cost = pbest_cost[everyone, best]
+    
+    searching = np.ones(classes, dtype=bool)
+    collisions = np.zeros(classes, dtype=int)
+    iterations = np.zeros(classes, dtype=int)
+    stagnant = np.zeros(classes, dtype=int)
+    # separates the swarms along the first dimension so a single spatial
+    # index finds the collisions of every swarm without pairing across them
+    separation = 2 * (ub[0] - lb[0] + minstep)
+    for i in range(maxiter):
+        active = np.flatnonzero(searching)
+        if len(active) == 0:
+            break
+        Instrumentation.count('pso_iterations', len(active))
+        started = Instrumentation.start()
+        x = position[active]
+        r1 = np.random.uniform(size=x.shape)
+        r2 = np.random.uniform(size=x.shape)
+        v = (w * inertia_decay**i * velocity[active] + c1 * r1 * (pbest_pos[active] - x) 
+             + c2 * r2 * (best_pos[active, None] - x))
+        v = np.clip(v, -vhigh, vhigh)
+        x = x + v
+        # particles leaving the bounds and colliding particles are respawned
+        offset = x.copy()
+        offset[:, :, 0] += np.arange(len(active))[:, None] * separation
+        collided = collision_respawns(offset.reshape(-1, dimensions), minstep).reshape(x.shape[:2])
+        collisions[active] += np.count_nonzero(collided, axis=1)
+        respawn = collided | np.any((x < lb) | (x > ub), axis=2)
+        respawned = np.count_nonzero(respawn)
+        if respawned:
+            x[respawn] = np.random.uniform(lb, ub, (respawned, dimensions))
+            v[respawn] = np.random.uniform(-vhigh, vhigh, (respawned, dimensions))
+        position[active] = x
+        velocity[active] = v
+        Instrumentation.stop('pso_update', started)
+        
+        bound = {'pbest_cost': pbest_cost[active]} if prune else {}
+        cost = evaluate(active, x, bound)
+        
+        started = Instrumentation.start()
+        improved = cost < pbest_cost[active]
+        pbest_pos[active] = np.where(improved[:, :, None], x, pbest_pos[active])
+        pbest_cost[active] = np.where(improved, cost, pbest_cost[active])
+        previous_pos = best_pos[active]
+        previous_cost = best_cost[active]
+        best = np.argmin(pbest_cost[active], axis=1)
+        best_pos[active] = pbest_pos[active, best]
+        best_cost[active] = pbest_cost[active, best]
+        iterations[active] = i
+        Instrumentation.stop('pso_best', started)
+        
+        # each swarm stops on custom_pso's criteria
+        gain = previous_cost - best_cost[active]
+        step_size = np.sqrt(np.sum((previous_pos - best_pos[active])**2, axis=1))
+        stagnant[active] = np.where(gain > 0, 0, stagnant[active] + 1)
+        stop = ((gain > 0) & (gain < minfunc)) | ((step_size < minstep) & (step_size != 0))
+        if patience is not None:
+            stop |= stagnant[active] >= patience
+        searching[active[stop]] = False
+    
+    print('Stopping search: {:} swarms stopped early, iterations {:} collisions {:}'.format(
+        np.count_nonzero(~searching), iterations + 1, collisions))
+    for c in range(classes):
+        Instrumentation.observe('iterations_to_convergence', iterations[c] + 1)
+    return [(best_pos[c], best_cost[c], collisions[c], iterations[c]) for c in range(classes)]
+
+def seeded_positions(estimate, lb, ub, swarmsize, fraction=0.5, spread=0.05):
+    """
+    Initial swarm positions where part of the swarm is seeded around an
+    estimate of the optimum and the rest is spread uniformly within bounds
+
+    Parameters
+    ==========
+    estimate : array
+        The estimated best position
+    lb : array
+        The lower bounds of the design variable(s)
+    ub : array
+        The upper bounds of the design variable(s)
+    swarmsize : int
+        The number of particles in the swarm
+    fraction : scalar
+        The proportion of the swarm seeded around the estimate (Default: 0.5)
+    spread : scalar
+        The standard deviation of the seeded particles around the estimate
+        as a proportion of the bounds (Default: 0.05)
+
+    Returns
+    =======
+    position : array
+        Initial positions of shape (swarmsize, dimensions), usable as
+        custom_pso's inital_position
+    """
+    lb = np.array(lb)
+    ub = np.array(ub)
+    seeded = int(round(fraction * swarmsize))
+    position = np.random.uniform(lb, ub, (swarmsize, len(lb)))
+    position[:seeded] = np.clip(estimate + np.random.normal(0, 1, (seeded, len(lb))) * spread * (ub - lb), lb, ub)
+    # keep one particle on the estimate itself
+    if seeded:
+        position[0] = np.clip(estimate, lb, ub)
+    return position
+
+def collision_respawns(position, minstep):
+    """
+    Finds the particles the collision check respawns in a single spatial
+    index pass instead of comparing every pair of particles
+    Particles are visited in order and a particle is respawned when it lies
+    within minstep of any particle that has not already been respawned, so
+    of two colliding particles only the first one moves
+
+    Parameters
+    ==========
+    position : array
+        The positions of the swarm (n_particles, dimensions)
+    minstep : scalar
+        The distance below which two particles collide
+
+    Returns
+    =======
+    respawn : array
+        Boolean mask of the particles to respawn
+    """
+    respawn = np.zeros(len(position), dtype=bool)
+    pairs = cKDTree(position).query_pairs(minstep, output_type='ndarray')
+    if len(pairs) == 0:
+        return respawn
+    # the query includes pairs exactly minstep apart
+    pairs = pairs[np.sum((position[pairs[:, 0]] - position[pairs[:, 1]])**2, axis=1) < minstep**2]
+    neighbours = {}
+    for k, j in pairs:
+        neighbours.setdefault(k, []).append(j)
+        neighbours.setdefault(j, []).append(k)
+    for k in sorted(neighbours):
+        respawn[k] = any(j > k or not respawn[j] for j in neighbours[k])
+    return respawn
+
+def memoized_objective(func):
+    """
+    Finds the MemoizedObjective of an objective, possibly wrapped by others
+    that keep the function they wrap as func
+
+    Returns
+    =======
+    cache : MemoizedObjective
+        The cache of func, None if it has none
+    """
+    while not isinstance(func, MemoizedObjective):
+        if not hasattr(func, 'func'):
+            return None
+        func = func.func
+    return func
+
+class MemoizedObjective:
+    """
+    LRU bounded memoization of a swarm objective function
+    Positions are quantized to a resolution per dimension and particles that
+    land on an already evaluated cell get its cached cost without calling
+    the objective, which pays off once a decayed swarm clusters tightly
+
+    Parameters
+    ==========
+    func : function
+        The swarm objective function, called as func(set_x, *args, **kwargs)
+    resolution : scalar or array
+        The cell size of the quantization per dimension
+    maxsize : int
+        The number of cached costs kept before the least recently used is
+        evicted (Default: 4096)
+    """
+    def __init__(self, func, resolution, maxsize=4096):
+        self.func = func
+        self.resolution = np.asarray(resolution, dtype=np.float64)
+        self.maxsize = maxsize
+        self.costs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def __call__(self, set_x, *args, **kwargs):
+        set_x = np.asarray(set_x)
+        keys = [cell.tobytes() for cell in np.round(set_x / self.resolution).astype(np.int64)]
+        cost_matrix = np.empty(len(set_x))
+        # particles sharing a cell within this batch are evaluated once
+        missing = {}
+        for particle, key in enumerate(keys):
+            if key in self.costs:
+                self.costs.move_to_end(key)
+                cost_matrix[particle] = self.costs[key]
+                self.hits += 1
+            else:
+                missing.setdefault(key, []).append(particle)
+        if missing:
+            first = [particles[0] for particles in missing.values()]
+            self.misses += len(first)
+            # warm start stores are keyed by swarm index, not index in the batch
+            if hasattr(kwargs.get('potentials'), 'subset'):
+                kwargs = dict(kwargs, potentials=kwargs['potentials'].subset(first))
+            for (key, particles), cost in zip(missing.items(), self.func(set_x[first], *args, **kwargs)):
+                cost_matrix[particles] = cost
+                self.costs[key] = cost
+            self.hits += sum(len(particles) - 1 for particles in missing.values())
+        while len(self.costs) > self.maxsize:
+            self.costs.popitem(last=False)
+            self.evictions += 1
+        return cost_matrix
+    
+    def report(self):
+        """
+        Returns
+        =======
+        counters : string
+            The hit, miss and eviction counts of the cache
+        """
+        return 'Objective cache hits {:} misses {:} evictions {:}'.format(self.hits, self.misses, self.evictions)
@@ -5,22 +5,123 @@ import numpy as np
 from ImageUtility import image_Points_Intensities, image_To_Outline, relation_Figure, ub, lb
 # from MNIST import random_Comparison_Set, random_Image
 from OptimalTransport import classify_Image
-from ParticleSwarm import objective_function_custom, optimal_sample_transform, optimal_sample_transform_test
-from Fonts import get_Random_Set, read_font, transform_image
+from ParticleSwarm import objective_function_batch, optimal_sample_transform, optimal_sample_transform_test
+from Fonts import get_Random_Set, read_font, transform_image, valid_font_paths, load_glyph_atlas
 from tqdm import tqdm
 import random
 import pandas as pd
 from IO import suppress_stdout
-from writer import write_To_Excel
+from writer import append_To_Log, export_Log_To_Excel, read_Log
+import Instrumentation
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import time, os
 
-def testPSO(cases, trials_per_case, display, display_Incorrect):
-    data = []
-    rows = []
-    cols = ['font', 'answer', 'classified_as']
+def trial_seed(seed, case, trial):
+    """
+    Derives the seed of a single trial so that any trial can be reproduced
+    on its own, independent of the order or process trials are run in
+
+    Args:
+        seed (int): seed of the whole sweep
+        case (int): case number
+        trial (int): trial number within the case
+
+    Returns:
+        int: seed of the trial
+    """
+    return int(np.random.SeedSequence([seed, case, trial]).generate_state(1)[0])
+
+TRIAL_CHARACTERS = '0123456789'
+TRIAL_SIZE = 30
+
+def run_trial(options, case, trial, seed):
+    """
+    Runs a single trial: picks a random font, transforms a random glyph
+    and classifies it, with font choice, transformation and PSO all drawn
+    from the trial's seed
+
+    Returns:
+        row (list): results log row of the trial, ending with the trial's
+            Instrumentation snapshot when options['instrument'] is set
+        transformed_Images (list of images): best transformations obtained
+        comparison_Set (list of images): glyphs of the chosen font
+        rand_Image (image): the transformed sample
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    Instrumentation.enable(options.get('instrument', False))
+    Instrumentation.reset()
+    # Fonts
+    original_Set, font = get_Random_Set(size=TRIAL_SIZE, characters=TRIAL_CHARACTERS)
+    comparison_Set = original_Set
+    # MNIST
+    # original_Set = random_Comparison_Set()
+    # font = 'MNIST'
+    # Convolution
+    # for k in range(len(original_Set)):
+    #     comparison_Set[k] = image_To_Outline(original_Set[k])
+        
+    rand_Answer = random.randint(0, len(comparison_Set) - 1)
+    rand_Image = transform_image(comparison_Set[rand_Answer])
+    # MNIST
+    # rand_Image, rand_Answer = random_Image()
+    
+    # PSO
+    options = dict(options, comp_set=comparison_Set, sample_image=rand_Image)
+    with suppress_stdout():
+        start = time.time()
+        transformed_Images, classified_As, xopt, log = optimal_sample_transform(options, log=True)
+    stages = Instrumentation.snapshot() if Instrumentation.ENABLED else None
+    row = [case, trial, seed, font, rand_Answer, classified_As, log['costs'], time.time() - start, xopt, stages]
+    return row, transformed_Images, comparison_Set, rand_Image
+
+def completed_trials(log_path):
+    """
+    Reads which trials a results log already holds, for resuming a sweep
+
+    Args:
+        log_path (string): path of the results log
+
+    Returns:
+        set: (case, trial) of every completed trial, empty when the log
+            holds no complete line
+    """
+    # a sweep killed mid append leaves a line without its newline, the next
+    # append would otherwise be joined onto it and lost
+    with open(log_path, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+    df = read_Log(log_path)
+    if df.empty or not {'case', 'trial'} <= set(df.columns):
+        return set()
+    return set(df[['case', 'trial']].itertuples(index=False, name=None))
+
+def testPSO(cases, trials_per_case, display, display_Incorrect, workers=1, seed=0, resume=True, instrument=False):
+    """
+    Runs cases * trials_per_case independent trials and logs their results,
+    trials are spread over a process pool when workers > 1 and every
+    completed trial is appended to the results log, so a rerun with resume
+    only runs the trials that did not complete
+
+    Args:
+        cases (int): number of cases
+        trials_per_case (int): number of trials per case
+        display (boolean): show the relation figure of every trial
+        display_Incorrect (boolean): show the relation figure of misclassified trials
+        workers (int): number of trial processes (Default: 1)
+        seed (int): seed of the sweep, see trial_seed (Default: 0)
+        resume (boolean): skip trials already in the results log (Default: True)
+        instrument (boolean): log the per stage counters and timings of every
+            trial, see Instrumentation (Default: False)
+    """
+    cols = ['case', 'trial', 'seed', 'font', 'answer', 'classified_as', 'costs', 'time', 'xopt', 'stages']
     options = {
                         'comp_set': None,
                         'sample_image': None,
-                        'func': objective_function_custom,
+                        'func': objective_function_batch,
                         'lb': lb,
                         'ub': ub,
                         'swarmsize': 40,
@@ -31,73 +132,103 @@ def testPSO(cases, trials_per_case, display, display_Incorrect):
                         'minstep': 1e-4,
                         'minfunc': 1e-5,
                         'debug': False,
-                        'inertia_decay': 0.96
+                        'inertia_decay': 0.96,
+                        'engine': 'custom_pso',
+                        'workers': 1,
+                        'race_rung': None,
+                        'race_eta': 2,
+                        'race_finalists': 2,
+                        'solver': 'emd',
+                        'reg': 0.03,
+                        'rescore_exact': True,
+                        'n_projections': 50,
+                        'rescore_top_k': 5,
+                        'cache_resolution': None,
+                        'cache_size': 4096,
+                        'seed_fraction': None,
+                        'seed_spread': 0.05,
+                        'max_points': None,
+                        'budget': 'superpixels',
+                        'prune_bound': False,
+                        'solve_translation': False,
+                        'refine_steps': None,
+                        'patience': None,
+                        'shrink': 1,
+                        'min_swarmsize': 5,
+                        'warp': 'staged',
+                        'pyramid': None,
+                        'pyramid_maxiter': None,
+                        'pyramid_fraction': 0.5,
+                        'pyramid_spread': 0.05,
+                        'instrument': instrument
                     }
-    progressBar = tqdm(total=cases * trials_per_case, desc='testPSO')
-    for i in range(cases):
-        totalCorrect = 0
-        testCases = trials_per_case
-        # Fonts
-        # original_Set, font = get_Random_Set(size=30, characters='0123456789')
-        # MNIST
-        # original_Set = random_Comparison_Set()
-        # font = 'MNIST'
-        # Convolution
-        # comparison_Set = original_Set
-        # for k in range(len(original_Set)):
-        #     comparison_Set[k] = image_To_Outline(original_Set[k])
-
-        for j in range(testCases):
-            
-            # Fonts
-            original_Set, font = get_Random_Set(size=30, characters='0123456789')
-            comparison_Set = original_Set
-            # for k in range(len(original_Set)):
-            #     comparison_Set[k] = image_To_Outline(original_Set[k])
-                
-            rand_Answer = random.randint(0, len(comparison_Set) - 1)
-            rand_Image = transform_image(comparison_Set[rand_Answer])
-            # MNIST
-            # rand_Image, rand_Answer = random_Image()
-            
-            # PSO
+    path = 'FontsRS-swarmSize={:},w={:},c1={:},c2={:},maxIter={:},minStep={:},minFunc={:},inertiaDecay={:}'.format(options['swarmsize'], options['w'], options['c1'], options['c2'], options['maxiter'], options['minstep'], options['minfunc'], options['inertia_decay'])
+    log_path = path + '.jsonl'
+    
+    completed = set()
+    if os.path.isfile(log_path):
+        if resume:
+            completed = completed_trials(log_path)
+        else:
+            os.remove(log_path)
+    pending = [(i, j) for i in range(cases) for j in range(trials_per_case) if (i, j) not in completed]
+    
+    progressBar = tqdm(total=cases * trials_per_case, initial=len(completed), desc='testPSO')
+    
+    def record(case, trial, result):
+        row, transformed_Images, comparison_Set, rand_Image = result
+        append_To_Log([row], cols, log_path)
+        font, rand_Answer, classified_As, xopt = row[3], row[4], row[5], row[8]
+        correct = rand_Answer == classified_As
+        if (display or (not correct and display_Incorrect)):
+            classified_As, relations = classify_Image(comparison_Set, transformed_Images)
+            xoptStr = np.array2string(xopt, precision=2, separator=',', suppress_small=True)    
+            title = font + ' ' + xoptStr
+            relation_Figure(comparison_Set, rand_Image, rand_Answer, transformed_Images, classified_As, relations, title)
+        progressBar.update(1)
+    
+    def failed(case, trial, e):
+        print(e)
+        tqdm.write('***************Test case {} of case {} failed***************'.format(trial, case))
+    
+    if workers > 1:
+        # bring the font index up to date once here, otherwise every worker
+        # would start its own scan of the fonts directory at the same time
+        valid_font_paths(TRIAL_CHARACTERS, './fonts')
+        if load_glyph_atlas(TRIAL_CHARACTERS, TRIAL_SIZE) is None:
+            tqdm.write('No glyph atlas for size {}, workers will render fonts'.format(TRIAL_SIZE))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run_trial, options, i, j, trial_seed(seed, i, j)): (i, j) for i, j in pending}
+            for future in as_completed(futures):
+                try:
+                    record(*futures[future], future.result())
+                except Exception as e:
+                    failed(*futures[future], e)
+    else:
+        for i, j in pending:
+            tqdm.write('***************BEGIN TEST CASE NUMBER {:}***************'.format(j))
             try:
-                with suppress_stdout():
-                    options['comp_set'] = comparison_Set
-                    options['sample_image'] = rand_Image
-                    tqdm.write('***************BEGIN TEST CASE NUMBER {:}***************'.format(j))
-                    transformed_Images, classified_As, xopt = optimal_sample_transform(options)
-                    rows.append([font, rand_Answer, classified_As])
+                record(i, j, run_trial(options, i, j, trial_seed(seed, i, j)))
             except Exception as e:
-                print(e)
-                tqdm.write('***************Test case failed with font {}***************'.format(font))
-                continue
-
-            correct = rand_Answer == classified_As
-                        
-            if (correct):
-                totalCorrect = totalCorrect + 1
-            
-            if (display or (not correct and display_Incorrect)):
-                classified_As, relations = classify_Image(comparison_Set, transformed_Images)
-                xoptStr = np.array2string(xopt, precision=2, separator=',', suppress_small=True)    
-                title = font + ' ' + xoptStr
-                relation_Figure(comparison_Set, rand_Image, rand_Answer, transformed_Images, classified_As, relations, title)
-            progressBar.update(1)
-        accuracy = totalCorrect / testCases * 100
-        data.append(accuracy)
-        tqdm.write('Accuracy for font {:} is {:}%'.format(font, accuracy))
-
-        path = 'FontsRS-swarmSize={:},w={:},c1={:},c2={:},maxIter={:},minStep={:},minFunc={:},inertiaDecay={:}.xlsx'.format(options['swarmsize'], options['w'], options['c1'], options['c2'], options['maxiter'], options['minstep'], options['minfunc'], options['inertia_decay'])
-        tqdm.write('Writing to excel file...')
-        write_To_Excel(rows=rows, cols=cols, sheetName='results', path=path)
-        rows = []
+                failed(i, j, e)
     
     progressBar.close()
+    if not os.path.isfile(log_path):
+        return
+    df = read_Log(log_path)
+    if df.empty or 'answer' not in df.columns:
+        return
+    correct = df['answer'] == df['classified_as']
+    data = (correct.groupby(df['case']).mean() * 100).tolist()
+    for case, accuracy in enumerate(data):
+        tqdm.write('Accuracy for case {:} is {:}%'.format(case, accuracy))
+    tqdm.write('Writing to excel file...')
+    export_Log_To_Excel(log_path=log_path, path=path + '.xlsx', sheetName='results')
     sb.displot(data, kde=True, bins=cases)
     
-    accuracy = np.sum(data) / cases
+    accuracy = np.sum(data) / len(data)
     string = "Accuracy is {}".format(accuracy)
     plt.title(string)
 
-testPSO(1, 30, display=False, display_Incorrect=False)
+if __name__ == '__main__':
+    testPSO(1, 30, display=False, display_Incorrect=False)
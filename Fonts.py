@@ -1,5 +1,6 @@
 from PIL import ImageFont, Image, ImageDraw
-import random, os, numpy as np
+import random, os, json, bisect, hashlib, tempfile, numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from ImageUtility import apply_transformations, display_Set, image_Points_Intensities, lb, ub, fft_deblur
 import matplotlib.pyplot as plt
 from fontTools.ttLib import TTFont
@@ -56,41 +57,154 @@ def read_font(fn, characters, size=28):
  
     return np.array(data)
 
-def write_valid_font_paths(characters, directory):
+FONT_INDEX = 'font_index.json'
+
+def font_coverage(path):
     """
-    Write the paths to all .ttf files in the provided directory that contain the provided characters to a file.
+    Reads the cmap coverage of a font without loading its other tables
+
+    Args:
+        path (string): path to a .ttf file
+
+    Returns:
+        list: sorted [first, last] code point ranges the font maps,
+            None if the font could not be read
+    """
+    try:
+        font = TTFont(path, lazy=True)
+        codepoints = set()
+        for table in font['cmap'].tables:
+            codepoints.update(table.cmap.keys())
+        font.close()
+    except Exception:
+        return None
+    ranges = []
+    for codepoint in sorted(codepoints):
+        if ranges and ranges[-1][1] == codepoint - 1:
+            ranges[-1][1] = codepoint
+        else:
+            ranges.append([codepoint, codepoint])
+    return ranges
+
+def write_json_atomically(data, path):
+    """
+    Writes json to a uniquely named temporary file next to path and swaps
+    it in, so concurrent writers never share a temporary file and readers
+    only ever see a complete file
+
+    Args:
+        data (dict): json serializable data
+        path (string): path of the file
+    """
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'w') as f:
+            json.dump(data, f)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+def update_font_index(directory, index_path=FONT_INDEX, workers=None):
+    """
+    Brings the persistent font index up to date with the fonts in a directory
+    Only fonts that are new or whose modification time or size changed are
+    rescanned, the scan is spread over a process pool
 
     Args:
-        characters (string): characters to check for
         directory (string): directory to start search in
+        index_path (string): path of the index file
+        workers (int): size of the process pool (Default: cpu count)
+
+    Returns:
+        dict: font path to {'mtime', 'size', 'coverage'}
     """
-    print('finding valid fonts')
-    # get all .ttf files in the directory that contain the desired characters
-    ttf_fonts = []
-    # walk through the directory
+    fonts = {}
+    if os.path.isfile(index_path):
+        with open(index_path, 'r') as f:
+            fonts = json.load(f)['fonts']
+    
+    found = {}
     for root, dir, files in os.walk(directory):
-        # for each file in the directory
         for file in files:
-            # if the file is a .ttf file
             if file.endswith(".ttf"):
-                
-                # get the path to the file
                 path = os.path.join(root, file)
-                # load the font
-                font = TTFont(path)
-                # check if the font contains all characters
-                for character in characters:
-                    for table in font['cmap'].tables:
-                        if ord(character) in table.cmap.keys():
-                            ttf_fonts.append(path)
-                            break
+                stat = os.stat(path)
+                found[path] = {'mtime': stat.st_mtime, 'size': stat.st_size}
+    
+    changed = [path for path, stat in found.items() 
+               if path not in fonts or fonts[path]['mtime'] != stat['mtime'] or fonts[path]['size'] != stat['size']]
+    if changed:
+        print('scanning {} new or changed fonts'.format(len(changed)))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for path, coverage in zip(changed, executor.map(font_coverage, changed, chunksize=16)):
+                fonts[path] = dict(found[path], coverage=coverage)
+    # drop fonts that were removed from the directory
+    removed = set(fonts) - set(found)
+    for path in removed:
+        del fonts[path]
+    
+    if changed or removed or not os.path.isfile(index_path):
+        write_json_atomically({'fonts': fonts}, index_path)
+    return fonts
+
+def font_covers(coverage, characters):
+    """
+    Args:
+        coverage (list): code point ranges of a font, see font_coverage
+        characters (string): characters to check for
+
+    Returns:
+        boolean: True if the font maps every character
+    """
+    if coverage is None:
+        return False
+    starts = [first for first, last in coverage]
+    for character in characters:
+        i = bisect.bisect_right(starts, ord(character)) - 1
+        if i < 0 or coverage[i][1] < ord(character):
+            return False
+    return True
+
+_font_indexes = {}
+_valid_fonts = {}
+
+def valid_font_paths(characters, directory):
+    """
+    Paths of the fonts in a directory that contain every provided character
+    The index is updated once per process and queries are kept per
+    character set, so a new character set never requires a rescan
+
+    Args:
+        characters (string): characters to check for
+        directory (string): directory to start search in
+
+    Returns:
+        list: paths to the valid .ttf files
+    """
+    if directory not in _font_indexes:
+        _font_indexes[directory] = update_font_index(directory)
+    key = (directory, characters)
+    if key not in _valid_fonts:
+        _valid_fonts[key] = sorted(path for path, font in _font_indexes[directory].items() 
+                                   if font_covers(font['coverage'], characters))
+    return _valid_fonts[key]
+
+def write_valid_font_paths(characters, directory):
+    """
+    Write the paths to all .ttf files in the provided directory that contain the provided characters to a file.
+
+    Args:
+        characters (string): characters to check for
+        directory (string): directory to start search in
+    """
     print('writing valid fonts')
     # write the character set to a file
     with open('characters.txt', 'w') as f:
         f.write(characters)
     # write the valid font paths to a file
     with open('valid_fonts.txt', 'w') as f:
-          f.write('\n'.join(ttf_fonts))
+          f.write('\n'.join(valid_font_paths(characters, directory)))
     print('done')    
                     
 def get_random_font_path(directory, characters):
@@ -103,22 +217,7 @@ def get_random_font_path(directory, characters):
     Returns:
         string: relative path to chosen .ttf file
     """
-    # if the file 'valid_fonts.txt' does not exist, write all valid font paths to this file
-    # also write the fonts if the character set has changed
-    file_found = os.path.isfile('valid_fonts.txt')
-    
-    if (os.path.isfile('characters.txt')):
-        characters_changed = open('characters.txt', 'r').read() != characters
-    else:
-        characters_changed = True
-            
-    if not file_found or characters_changed:
-        write_valid_font_paths(characters, directory)
-    
-    ttf_fonts = []
-    # read all valid font paths from the file 'valid_fonts.txt'
-    with open('valid_fonts.txt', 'r') as f:
-        ttf_fonts = f.read().splitlines()
+    ttf_fonts = valid_font_paths(characters, directory)
                     
     if not ttf_fonts:
         return None
@@ -127,9 +226,130 @@ def get_random_font_path(directory, characters):
     random_font = random.choice(ttf_fonts)
     return os.path.relpath(random_font, directory)
 
+ATLAS_DIRECTORY = 'glyph_atlas'
+
+def atlas_paths(characters, size):
+    """
+    Args:
+        characters (string): characters of the atlas
+        size (int): resolution of the atlas glyphs
+
+    Returns:
+        tuple: path of the atlas array and of its index
+    """
+    name = '{}_{}'.format(size, hashlib.sha1(characters.encode()).hexdigest()[:12])
+    return (os.path.join(ATLAS_DIRECTORY, name + '.npy'), 
+            os.path.join(ATLAS_DIRECTORY, name + '.json'))
+
+def render_font(path, characters, size):
+    """
+    read_font for worker processes
+
+    Returns:
+        images: rendered glyphs, None if the font could not be rendered
+    """
+    try:
+        return read_font(path, characters, size)
+    except OSError:
+        return None
+
+def read_atlas_index(index_path):
+    """
+    Returns:
+        dict: the atlas index, None if no atlas was built
+    """
+    try:
+        with open(index_path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def remove_quietly(path):
+    """
+    Removes a file that may already be gone
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def build_glyph_atlas(characters='0123456789', sizes=(28,), directory='./fonts', workers=None):
+    """
+    Renders every valid font's glyphs once into a uint8 atlas on disk,
+    one (fonts, characters, size, size) array per size along with an index
+    of the font each row belongs to, so later lookups are memory-mapped
+    slices instead of renders
+
+    Args:
+        characters (string): characters to render
+        sizes (list of int): resolutions to render
+        directory (string): directory to search for fonts
+        workers (int): size of the process pool (Default: cpu count)
+    """
+    os.makedirs(ATLAS_DIRECTORY, exist_ok=True)
+    paths = valid_font_paths(characters, directory)
+    for size in sizes:
+        print('rendering {} fonts at size {}'.format(len(paths), size))
+        atlas_path, index_path = atlas_paths(characters, size)
+        atlas = np.lib.format.open_memmap(atlas_path + '.tmp', mode='w+', dtype=np.uint8, 
+                                          shape=(len(paths), len(characters), size, size))
+        fonts = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            renders = executor.map(render_font, paths, [characters] * len(paths), [size] * len(paths), chunksize=16)
+            for path, images in zip(paths, renders):
+                # skip fonts that cannot be rendered
+                if images is not None:
+                    atlas[len(fonts)] = images
+                    fonts.append(os.path.relpath(path, directory))
+        atlas.flush()
+        del atlas
+        # trim the rows of fonts that failed to render
+        # into a uniquely named file, the index only names it once both are
+        # complete so a reader never pairs an atlas with another build's fonts
+        descriptor, generation = tempfile.mkstemp(dir=ATLAS_DIRECTORY, prefix=os.path.basename(atlas_path)[:-len('.npy')] + '.', 
+                                                  suffix='.npy')
+        rendered = np.lib.format.open_memmap(atlas_path + '.tmp', mode='r')[:len(fonts)]
+        with os.fdopen(descriptor, 'wb') as f:
+            np.save(f, rendered)
+        del rendered
+        os.remove(atlas_path + '.tmp')
+        previous = read_atlas_index(index_path)
+        write_json_atomically({'characters': characters, 'size': size, 'fonts': fonts, 
+                               'atlas': os.path.basename(generation)}, index_path)
+        if previous is not None and previous.get('atlas') != os.path.basename(generation):
+            remove_quietly(os.path.join(ATLAS_DIRECTORY, previous.get('atlas', os.path.basename(atlas_path))))
+    print('done')
+
+_atlases = {}
+
+def load_glyph_atlas(characters, size):
+    """
+    Memory-maps the atlas of a character set and size, once per process
+
+    Returns:
+        tuple: (atlas array, font paths) or None if no atlas was built
+    """
+    key = (characters, size)
+    if key not in _atlases:
+        atlas_path, index_path = atlas_paths(characters, size)
+        _atlases[key] = None
+        index = read_atlas_index(index_path)
+        while index is not None:
+            try:
+                atlas = np.load(os.path.join(ATLAS_DIRECTORY, index.get('atlas', os.path.basename(atlas_path))), mmap_mode='r')
+                _atlases[key] = (atlas, index['fonts'])
+                break
+            except FileNotFoundError:
+                # a rebuild replaced the atlas after its index was read
+                newer = read_atlas_index(index_path)
+                index = newer if newer != index else None
+    return _atlases[key]
+
 def get_Random_Set(characters = '0123456789', size = 28):
     """
     generates the provided characters with a random font
+    glyphs come from the glyph atlas when one was built for the characters
+    and size, otherwise the font is rendered
 
     Args:
         characters (string): desired characters to generate
@@ -137,6 +357,12 @@ def get_Random_Set(characters = '0123456789', size = 28):
     Returns:
         images: array of images
     """
+    atlas = load_glyph_atlas(characters, size)
+    if atlas is not None and len(atlas[1]):
+        glyphs, fonts = atlas
+        i = random.randrange(len(fonts))
+        return np.array(glyphs[i]), fonts[i]
+    
     # There is an os issue with some invalid font, must correct
     # For now this is a valid work around
     Error = True
@@ -2,8 +2,11 @@ import numpy as np
 from PIL import Image
 import matplotlib.pyplot as plt
 import inflect, cv2
+import Instrumentation
 
-def image_Points_Intensities(image):
+BUDGETS = ('superpixels', 'top_mass')
+
+def image_Points_Intensities(image, max_points=None, budget='superpixels'):
     """
     Takes an image and returns the points of the image and
     the intensities for each respective point
@@ -12,13 +15,108 @@ def image_Points_Intensities(image):
 
     Args:
         image (array-like image): source image
+        max_points (int): optional bound on the number of points,
+            see budget_support (Default: None, every point is kept)
+        budget (string): one of BUDGETS, how the support is reduced
     """
     a = np.argwhere(image > 30)
         
     SA = image[a[:, 0], a[:, 1]]
     SA = SA / np.sum(SA)
+    if max_points is not None:
+        a, SA = record_budget(*budget_support(a, SA, max_points, budget))
     return a, SA
 
+def image_Points_Intensities_batch(images, max_points=None, budget='superpixels'):
+    """
+    Takes a stack of images and returns the points and intensities
+    of every image in a single pass over the stack
+    
+    Please note that images are stored in y, x format
+
+    Args:
+        images (array-like (n, height, width)): source images
+        max_points (int): optional bound on the number of points of
+            each image, see budget_support (Default: None)
+        budget (string): one of BUDGETS, how the supports are reduced
+
+    Returns:
+        extracts (list of [point, weight]): one image_Points_Intensities
+            result per image in the stack
+    """
+    images = np.asarray(images)
+    n, y, x = np.nonzero(images > 30)
+    values = images[n, y, x]
+    counts = np.bincount(n, minlength=len(images))
+    totals = np.bincount(n, weights=values, minlength=len(images))
+    
+    points = np.stack([y, x], axis=1)
+    weights = values / totals[n]
+    splits = np.cumsum(counts)[:-1]
+    extracts = list(zip(np.split(points, splits), np.split(weights, splits)))
+    if max_points is not None:
+        extracts = [record_budget(*budget_support(b, DB, max_points, budget)) for b, DB in extracts]
+    return extracts
+
+def budget_support(points, weights, max_points, budget='superpixels'):
+    """
+    Reduces a point set to at most max_points points so the size of the
+    OT problem it takes part in is bounded, the mass stays normalized
+
+    superpixels: pixels are merged into square cells, the smallest cell
+        size that gives at most max_points cells is used, each cell becomes
+        one point at its centroid carrying the cell's total mass
+    top_mass: only the max_points heaviest pixels are kept and their
+        weights are rescaled to sum to one
+
+    Args:
+        points (np array (n, 2)): points of an extract
+        weights (np array (n,)): normalized weight of each point
+        max_points (int): largest number of points kept
+        budget (string): one of BUDGETS
+
+    Returns:
+        points (np array): reduced points
+        weights (np array): reduced weights summing to one
+        error (number): upper bound on the squared euclidean transport cost,
+            in pixels squared, between the original and reduced sets
+    """
+    if len(points) <= max_points:
+        return points, weights, 0.0
+    if budget == 'superpixels':
+        for size in range(2, max(points.max(initial=0), 1) + 2):
+            cells, inverse = np.unique(points // size, axis=0, return_inverse=True)
+            if len(cells) <= max_points:
+                break
+        inverse = inverse.ravel()
+        mass = np.bincount(inverse, weights=weights)
+        centroids = np.stack([np.bincount(inverse, weights=weights * points[:, d]) for d in range(2)], axis=1) / mass[:, None]
+        # moving every pixel to its cell's centroid is a valid transport plan
+        error = np.sum(weights * np.sum((points - centroids[inverse])**2, axis=1))
+        return centroids, mass / np.sum(mass), error
+    if budget == 'top_mass':
+        keep = np.argpartition(weights, -max_points)[-max_points:]
+        dropped = np.ones(len(points), dtype=bool)
+        dropped[keep] = False
+        kept = weights[keep] / np.sum(weights[keep])
+        # kept pixels stay in place and each dropped pixel's mass is spread
+        # over the kept pixels in proportion to their rescaled weights
+        distances = np.sum((points[dropped][:, None, :] - points[keep][None, :, :])**2, axis=2)
+        error = weights[dropped] @ (distances @ kept)
+        return points[keep], kept, error
+    raise ValueError('budget must be one of {}'.format(BUDGETS))
+
+def record_budget(points, weights, error):
+    """
+    Records the approximation error of a budgeted support with Instrumentation
+
+    Returns:
+        points, weights: unchanged
+    """
+    Instrumentation.count('budgeted_supports', int(error > 0))
+    Instrumentation.observe('budget_error', error)
+    return points, weights
+
 def image_To_GrayScale(image):
     """
     if image is not already grayscale will convert and return converted
@@ -219,6 +317,262 @@ def apply_transformations(x, image):
     
     return brighten_image(image)
 
+def transformation_matrices(X, shape):
+    """
+    Builds the rotation, translation, scale and shear matrices used by
+    apply_transformations for every particle position in X
+
+    Args:
+        X (array-like (n, 7)): positions of particles in the swarm
+        shape (tuple): shape of the image to be transformed
+
+    Returns:
+        matrices (list of np array): four (n, 2, 3) stacks of affine
+            matrices in the order they are applied
+    """
+    X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+    height, width = shape[:2]
+    center_x, center_y = width / 2, height / 2
+    zeros = np.zeros(len(X))
+    ones = np.ones(len(X))
+    
+    def affine(m00, m01, m02, m10, m11, m12):
+        return np.stack([np.stack([m00, m01, m02], axis=1),
+                         np.stack([m10, m11, m12], axis=1)], axis=1)
+    
+    # same form as cv2.getRotationMatrix2D with a scale of 1
+    alpha = np.cos(np.radians(X[:, 0]))
+    beta = np.sin(np.radians(X[:, 0]))
+    rotation = affine(alpha, beta, (1 - alpha) * center_x - beta * center_y,
+                      -beta, alpha, beta * center_x + (1 - alpha) * center_y)
+    translation = affine(ones, zeros, X[:, 1] * width,
+                         zeros, ones, X[:, 2] * height)
+    scale = affine(1 + X[:, 3], zeros, zeros,
+                   zeros, 1 + X[:, 4], zeros)
+    shear = affine(ones, X[:, 5], zeros,
+                   X[:, 6], ones, zeros)
+    return [rotation, translation, scale, shear]
+
+def compose_transformations(X, shape):
+    """
+    Composes the four matrices of transformation_matrices into the single
+    forward affine that maps original pixel coordinates to their position
+    in the transformed image
+
+    Args:
+        X (array-like (n, 7)): positions of particles in the swarm
+        shape (tuple): shape of the image to be transformed
+
+    Returns:
+        composed (np array (n, 2, 3)): forward affine matrix per particle
+    """
+    composed = None
+    for matrices in transformation_matrices(X, shape):
+        homogeneous = np.concatenate([matrices, np.tile([[[0, 0, 1]]], (len(matrices), 1, 1))], axis=1)
+        composed = homogeneous if composed is None else homogeneous @ composed
+    return composed[:, :2]
+
+def transform_points_batch(X, points, shape):
+    """
+    Applies the transformations of every particle position in X directly
+    to a set of points instead of warping and re-extracting the image
+    
+    Please note that points are stored in y, x format
+
+    Args:
+        X (array-like (n, 7)): positions of particles in the swarm
+        points (np array (k, 2)): points extracted from the original image
+        shape (tuple): shape of the original image
+
+    Returns:
+        transformed (np array (n, k, 2)): transformed points per particle
+    """
+    composed = compose_transformations(X, shape)
+    xy = points[:, ::-1].astype(np.float64)
+    transformed = np.einsum('nij,kj->nki', composed[:, :, :2], xy) + composed[:, None, :, 2]
+    return transformed[..., ::-1]
+
+def weighted_moments(extract):
+    """
+    First and second moments of a point/weight set
+
+    Args:
+        extract ([point, weight]): image_Points_Intensities result
+
+    Returns:
+        centroid (np array): weighted mean in x, y format
+        covariance (np array): 2x2 weighted covariance in x, y format
+    """
+    points, weights = extract
+    xy = points[:, ::-1].astype(np.float64)
+    centroid = weights @ xy
+    centered = xy - centroid
+    covariance = (weights[:, None] * centered).T @ centered
+    return centroid, covariance
+
+def moment_alignment(comp_extract, sample_extract, shape, lower_bound=lb, upper_bound=ub):
+    """
+    Closed form estimate of the transformation that aligns the sample to the
+    comparison image by matching their image moments:
+        rotation aligns the principal axes of the covariances
+        scale and shear map the rotated sample covariance onto the comparison
+        covariance (M = C^1/2 S^-1/2)
+        translation moves the sample centroid onto the comparison centroid
+
+    Args:
+        comp_extract ([point, weight]): comparison image extract
+        sample_extract ([point, weight]): sample image extract
+        shape (tuple): shape of the sample image
+        lower_bound (list): lower bounds of the transformation
+        upper_bound (list): upper bounds of the transformation
+
+    Returns:
+        x (np array): estimated particle position clipped to the bounds
+    """
+    comp_centroid, comp_covariance = weighted_moments(comp_extract)
+    sample_centroid, sample_covariance = weighted_moments(sample_extract)
+    x = np.zeros(7)
+    
+    # rotation by x[0] turns a direction by -x[0] in x, y coordinates,
+    # principal axes have no sign so the angle is taken modulo 180 degrees
+    comp_axis = np.linalg.eigh(comp_covariance)[1][:, -1]
+    sample_axis = np.linalg.eigh(sample_covariance)[1][:, -1]
+    angle = np.degrees(np.arctan2(sample_axis[1], sample_axis[0]) - np.arctan2(comp_axis[1], comp_axis[0]))
+    x[0] = (angle + 90) % 180 - 90
+    
+    def root(matrix, power):
+        values, vectors = np.linalg.eigh(matrix)
+        return vectors @ np.diag(np.maximum(values, 1e-9)**power) @ vectors.T
+    
+    rotation = transformation_matrices(x, shape)[0][0, :, :2]
+    rotated_covariance = rotation @ sample_covariance @ rotation.T
+    # shear @ scale = [[sx, shx * sy], [shy * sx, sy]]
+    linear = root(comp_covariance, 0.5) @ root(rotated_covariance, -0.5)
+    x[3] = linear[0, 0] - 1
+    x[4] = linear[1, 1] - 1
+    x[5] = linear[0, 1] / linear[1, 1]
+    x[6] = linear[1, 0] / linear[0, 0]
+    x[3:] = np.clip(x[3:], lower_bound[3:], upper_bound[3:])
+    
+    x = centroid_translation(x, comp_centroid, sample_centroid, shape, lower_bound, upper_bound)[0]
+    return np.clip(x, lower_bound, upper_bound)
+
+def centroid_translation(X, comp_centroid, sample_centroid, shape, lower_bound=lb, upper_bound=ub):
+    """
+    Sets the translation of every position in X to the one that moves the
+    transformed sample centroid onto the comparison centroid, for squared
+    euclidean costs this is the optimal translation of the transport problem
+    whatever the rest of the transformation is
+
+    Args:
+        X (array-like (n, 7)): positions of particles in the swarm, their
+            translations are ignored
+        comp_centroid (np array): comparison centroid in x, y format
+        sample_centroid (np array): sample centroid in x, y format
+        shape (tuple): shape of the sample image
+        lower_bound (list): lower bounds of the transformation
+        upper_bound (list): upper bounds of the transformation
+
+    Returns:
+        X (np array (n, 7)): positions with translations clipped to the bounds
+    """
+    X = np.array(np.atleast_2d(X), dtype=np.float64)
+    height, width = shape[:2]
+    X[:, 1:3] = 0
+    composed = compose_transformations(X, shape)
+    rotation = transformation_matrices(X, shape)[0][:, :, :2]
+    moved = composed[:, :, :2] @ sample_centroid + composed[:, :, 2]
+    # translation is applied before scale and shear
+    translation = np.linalg.solve(composed[:, :, :2] @ np.linalg.inv(rotation), (comp_centroid - moved)[:, :, None])[:, :, 0]
+    X[:, 1] = translation[:, 0] / width
+    X[:, 2] = translation[:, 1] / height
+    X[:, 1:3] = np.clip(X[:, 1:3], lower_bound[1:3], upper_bound[1:3])
+    return X
+
+def apply_transformations_batch(X, image):
+    """
+    Applies the transformations of every particle position in X to the
+    same image, the matrices of the whole swarm are built in one pass and
+    each particle is warped by the same cv2 stages as apply_transformations
+    into a single preallocated stack
+
+    Args:
+        X (array-like (n, 7)): positions of particles in the swarm
+        image (image): original image to be transformed
+
+    Returns:
+        images (np array (n, height, width)): transformed image per particle
+    """
+    X = np.atleast_2d(X)
+    height, width = image.shape[:2]
+    images = np.empty((len(X), height, width), dtype=image.dtype)
+    stages = zip(*[matrices.astype(np.float32) for matrices in transformation_matrices(X, image.shape)])
+    for particle_matrices, destination in zip(stages, images):
+        warped = image
+        for matrix in particle_matrices:
+            warped = cv2.warpAffine(warped, matrix, (width, height))
+        destination[...] = warped
+    return brighten_image(images)
+
+def apply_transformations_composed(x, image, out=None):
+    """
+    Applies the transformations of x as a single affine warp, the four
+    matrices of apply_transformations are composed so the image is only
+    resampled once. Unlike apply_transformations, content that an
+    intermediate stage would move out of frame is not clipped
+
+    Args:
+        x (list / vector): position of a particle in the swarm
+        image (image): original image to be transformed
+        out (np array): optional preallocated image of the same shape and
+            type as image that the result is written into
+
+    Returns:
+        image (image): transformed image, out when it was given
+    """
+    height, width = image.shape[:2]
+    matrix = compose_transformations(x, image.shape)[0]
+    return brighten_image(cv2.warpAffine(image, matrix, (width, height), dst=out))
+
+def apply_transformations_composed_batch(X, image, out=None):
+    """
+    apply_transformations_composed for every particle position in X
+
+    Args:
+        X (array-like (n, 7)): positions of particles in the swarm
+        image (image): original image to be transformed
+        out (np array (n, height, width)): optional preallocated stack the
+            results are written into, at least as long as X
+
+    Returns:
+        images (np array (n, height, width)): transformed image per particle
+    """
+    X = np.atleast_2d(X)
+    if out is None:
+        out = np.empty((len(X),) + image.shape[:2], dtype=image.dtype)
+    out = out[:len(X)]
+    height, width = image.shape[:2]
+    for matrix, destination in zip(compose_transformations(X, image.shape), out):
+        cv2.warpAffine(image, matrix, (width, height), dst=destination)
+    return brighten_image(out)
+
+def downsample_image(image, factor):
+    """
+    Shrinks an image for the coarse levels of a pyramid search, area
+    interpolation averages strokes rather than skipping them so thin glyphs
+    keep their mass above the point threshold
+
+    Args:
+        image (image): original image
+        factor (number): proportion of the original size, e.g. 0.5
+
+    Returns:
+        image (image): downsampled image
+    """
+    height, width = image.shape[:2]
+    size = (max(1, int(round(width * factor))), max(1, int(round(height * factor))))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
 def brighten_image(image):
     """
     Brightens the image by a random amount
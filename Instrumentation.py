@@ -0,0 +1,110 @@
+import time, math
+from collections import defaultdict
+
+# Per stage counters and timing histograms for the PSO / OT hot path
+# Disabled by default, when disabled every call returns after a single check
+#
+# Usage:
+#     Instrumentation.enable()
+#     started = Instrumentation.start()
+#     ... stage ...
+#     Instrumentation.stop('stage', started)
+#     Instrumentation.snapshot()
+
+ENABLED = False
+
+_counters = defaultdict(int)
+_histograms = defaultdict(lambda: {'count': 0, 'total': 0.0, 'min': math.inf, 'max': -math.inf, 'buckets': defaultdict(int)})
+
+def enable(enabled=True):
+    """
+    Turns instrumentation on or off for this process
+
+    Args:
+        enabled (boolean): whether stages are recorded (Default: True)
+    """
+    global ENABLED
+    ENABLED = enabled
+
+def reset():
+    """
+    Clears every counter and histogram, e.g. at the start of a trial
+    """
+    _counters.clear()
+    _histograms.clear()
+
+def start():
+    """
+    Returns:
+        started (number): start time of a stage, None when disabled
+    """
+    return time.perf_counter() if ENABLED else None
+
+def stop(name, started):
+    """
+    Records the duration of a stage begun with start()
+
+    Args:
+        name (string): stage name
+        started (number): value returned by start()
+    """
+    if started is not None:
+        observe(name + '_seconds', time.perf_counter() - started)
+
+def count(name, value=1):
+    """
+    Adds to a counter
+
+    Args:
+        name (string): counter name
+        value (number): amount to add (Default: 1)
+    """
+    if ENABLED:
+        _counters[name] += value
+
+def observe(name, value):
+    """
+    Records a value in a histogram with power of two buckets
+
+    Args:
+        name (string): histogram name
+        value (number): observed value, e.g. seconds or a support size
+    """
+    if ENABLED:
+        histogram = _histograms[name]
+        histogram['count'] += 1
+        histogram['total'] += value
+        histogram['min'] = min(histogram['min'], value)
+        histogram['max'] = max(histogram['max'], value)
+        histogram['buckets'][math.frexp(value)[1] if value > 0 else None] += 1
+
+def snapshot():
+    """
+    Returns:
+        snapshot (dict): json serializable copy of the counters and
+            histograms, histogram buckets are keyed by the exponent e of
+            their upper bound 2**e
+    """
+    return {
+        'counters': dict(_counters),
+        'histograms': {name: dict(histogram, buckets={str(bucket): n for bucket, n in histogram['buckets'].items()})
+                       for name, histogram in _histograms.items()},
+    }
+
+def merge(other):
+    """
+    Adds a snapshot taken in another process into this process' records
+
+    Args:
+        other (dict): value returned by snapshot()
+    """
+    for name, value in other['counters'].items():
+        _counters[name] += value
+    for name, other_histogram in other['histograms'].items():
+        histogram = _histograms[name]
+        histogram['count'] += other_histogram['count']
+        histogram['total'] += other_histogram['total']
+        histogram['min'] = min(histogram['min'], other_histogram['min'])
+        histogram['max'] = max(histogram['max'], other_histogram['max'])
+        for bucket, n in other_histogram['buckets'].items():
+            histogram['buckets'][None if bucket == 'None' else int(bucket)] += n
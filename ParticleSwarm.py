@@ -1,13 +1,16 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import pyswarm
-from CustomPSO import custom_pso
-from OptimalTransport import POT_Parameterized, L1
-from ImageUtility import apply_transformations, image_Points_Intensities, lb, ub
+from CustomPSO import custom_pso, pso_search, run_search, multi_swarm_pso, seeded_positions, MemoizedObjective
+from OptimalTransport import POT_Parameterized, DualPotentials, WARM_STARTED_SOLVERS, DEFAULT_REG, sliced_Wasserstein, transport_cost_gradient, L1
+from ImageUtility import apply_transformations, apply_transformations_batch, apply_transformations_composed_batch, image_Points_Intensities, image_Points_Intensities_batch, transform_points_batch, moment_alignment, centroid_translation, weighted_moments, downsample_image, lb, ub
 from IO import suppress_stdout
+import Instrumentation
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import minimize
 import time
 
-def optimal_sample_transform(options):
+def optimal_sample_transform(options, log=False):
     """
     Takes a comparison set and a sample image
     Performs PSO with POT as a cost descriptor
@@ -16,28 +19,112 @@ def optimal_sample_transform(options):
         Rotation
 
     Args:
-        comp_set (list of images): original forms
-        sample_image (image): variation
+        options (dict): custom_pso parameters along with
+            comp_set (list of images): original forms
+            sample_image (image): variation
+            workers (int): optional size of a process pool to spread the
+                candidates over (Default: 1, sequential)
+            executor (concurrent.futures.Executor): optional existing pool
+                to use instead of creating one per call
+            engine (string): 'custom_pso' runs a pyswarms based search per
+                candidate, 'multi_swarm' searches every candidate at once,
+                see fit_candidates_multi_swarm (Default: 'custom_pso')
+            race_rung (int): optional number of iterations per rung of a
+                successive halving race between the candidates, see
+                race_candidates (Default: None, every candidate runs fully)
+            solver (string): OT solver of the search, see objective_kwargs
+            rescore_exact (boolean): re-score each candidate's best position
+                with exact EMD when the search used an entropic solver
+            rescore_top_k (int): for approximate objectives such as
+                objective_function_sliced, the number of each swarm's best
+                positions re-evaluated with the exact objective (Default: 5)
+            cache_resolution (number): optional quantization of positions, as
+                a fraction of each dimension's bounds, below which particles
+                share a memoized cost (Default: None, no cache)
+            cache_size (int): number of memoized costs kept (Default: 4096)
+            seed_fraction (number): optional proportion of each swarm seeded
+                around the moment_alignment estimate (Default: None, none)
+            seed_spread (number): spread of the seeded particles as a
+                proportion of the bounds (Default: 0.05)
+            max_points (int): optional bound on the points of every extract,
+                see ImageUtility.budget_support (Default: None, no bound)
+            budget (string): how extracts are reduced to max_points, one of
+                ImageUtility.BUDGETS (Default: 'superpixels')
+            prune_bound (boolean): skip OT solves whose cheap lower bound
+                already exceeds the particle's personal best, see
+                OptimalTransport.wasserstein_lower_bound, not combined with
+                cache_resolution (Default: False)
+            patience (int): optional number of iterations without improvement
+                after which a search stops, see custom_pso
+            shrink (number): proportion of a swarm kept after an iteration
+                without improvement (Default: 1, fixed swarm size)
+            min_swarmsize (int): smallest shrunk swarm (Default: 5)
+            refine_steps (int): optional quasi-Newton iterations refining
+                each candidate's best position with the transport plan's
+                gradient, see refine_result (Default: None, no refinement)
+            solve_translation (boolean): search only rotation, scale and
+                shear, translation is solved by aligning centroids inside
+                every evaluation, see TranslationSolvedObjective (Default: False)
+            warp (string): 'staged' or 'composed' warp of the raster
+                objectives, see raster_arguments (Default: 'staged')
+            pyramid (list of number): optional downsampling factors of coarse
+                levels searched before full resolution, see pyramid_search,
+                raced candidates always run at full resolution
+                (Default: None, full resolution only)
+        log (boolean): also return a log of the search (Default: False)
     Returns:
         best_images (array of images): best transformations obtained
         min_answer (number): the candidate sample was identified as
+        xopt (array): best transformation of the identified candidate
+        log (dict): only if log is True, the cost, iterations and
+            collisions of each candidate
     """    
     
+    started = Instrumentation.start()
+    Instrumentation.count('classifications')
+    sample = sample_argument(options['func'], options['sample_image'], **budget_arguments(options))
+    if options.get('race_rung'):
+        results = race_candidates(options, sample)
+    elif options.get('engine') == 'multi_swarm':
+        results = fit_candidates_multi_swarm(options, sample)
+    elif options.get('executor') is not None:
+        results = fit_candidates_parallel(options['executor'], options, sample)
+    elif options.get('workers', 1) > 1:
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            results = fit_candidates_parallel(executor, options, sample)
+    else:
+        results = [fit_candidate(options, comp_image, sample) for comp_image in options['comp_set']]
+    classification = select_candidate(options, sample, results, log)
+    Instrumentation.stop('classification', started)
+    return classification
+
+def select_candidate(options, sample, results, log=False):
+    """
+    Identifies the sample as the candidate whose fit has the lowest cost
+
+    Args:
+        options (dict): optimal_sample_transform options
+        sample (tuple): sample arguments built by sample_argument
+        results (list): fit_candidate return values in comparison set order
+        log (boolean): also return a log of the search (Default: False)
+    Returns:
+        optimal_sample_transform return values
+    """
     best_images = []
     min_score = float('infinity')
     min_answer = 0
     # fit to each pattern
     collisionsArr = []
     itterations = []
-    for i in range(len(options['comp_set'])):
-        xopt, fopt, collisions, it = custom_pso(func=options['func'], lb=options['lb'], 
-                                ub=options['ub'], args=(image_Points_Intensities(options['comp_set'][i]), 
-                                options['sample_image']), swarmsize=options['swarmsize'], w=options['w'], 
-                                c1=options['c1'], c2=options['c2'],maxiter=options['maxiter'], 
-                                minstep=options['minstep'], minfunc=options['minfunc'],
-                                debug=options['debug'], inertia_decay=options['inertia_decay'])
+    xopts = []
+    costs = []
+    if options.get('rescore_exact') and options.get('solver', 'emd') != 'emd':
+        results = rescore_exact(options, sample, results)
+    for i, (xopt, fopt, collisions, it) in enumerate(results):
         collisionsArr.append(collisions)
         itterations.append(it)
+        xopts.append(xopt)
+        costs.append(fopt)
         if (min_score > fopt):
             min_answer = i
             min_score = fopt
@@ -47,7 +134,622 @@ def optimal_sample_transform(options):
     # plt.ylabel("collisions, avg {:}".format(np.average(collisionsArr)))
     # m, b = np.polyfit(itterations, collisionsArr, 1)
     # plt.plot(itterations, m*np.array(itterations) + b)
-    return best_images, min_answer, xopt
+    if log:
+        return best_images, min_answer, xopts[min_answer], {'costs': costs, 'iterations': itterations, 
+                                                            'collisions': collisionsArr}
+    return best_images, min_answer, xopts[min_answer]
+
+def fit_candidate(options, comp_image, sample, seed=None, comp_extract=None, potentials=None):
+    """
+    Runs custom_pso to fit the sample to a single comparison image
+
+    Args:
+        options (dict): optimal_sample_transform options
+        comp_image (image): original form
+        sample (tuple): sample arguments built by sample_argument
+        seed (int): optional seed for numpy's random state, used when the
+            candidate runs in a worker process
+        comp_extract, potentials: optional state kept between samples,
+            see pso_arguments
+    Returns:
+        custom_pso return values
+    """
+    if seed is not None:
+        np.random.seed(seed)
+    if options.get('pyramid'):
+        result = pyramid_search(options, comp_image, sample, comp_extract, potentials)
+    else:
+        arguments = pso_arguments(options, comp_image, sample, comp_extract, potentials)
+        result = full_result(arguments, custom_pso(**arguments))
+        report_cache(arguments)
+    if options.get('refine_steps'):
+        result = refine_result(options, comp_image, sample, result, comp_extract)
+    return result
+
+def refine_result(options, comp_image, sample, result, comp_extract=None):
+    """
+    Local refinement of a search's best position with the gradient given by
+    the transport plan, a few quasi-Newton (L-BFGS-B) steps within the bounds
+    replace the long tail of PSO iterations creeping towards minstep/minfunc
+    The refined position is kept only if the search's objective agrees it is
+    better, the gradient is that of the point space cost even when the
+    search warps the image
+
+    Args:
+        options (dict): optimal_sample_transform options along with
+            refine_steps (int): iterations of the refinement
+        comp_image (image): original form
+        sample (tuple): sample arguments built by sample_argument
+        result (tuple): custom_pso return values
+        comp_extract ([point, weight]): optional precomputed extract of comp_image
+    Returns:
+        result (tuple): custom_pso return values, with the refined position
+            and cost when they improved on the search's
+    """
+    xopt, fopt, collisions, it = result
+    if not np.isfinite(fopt):
+        return result
+    started = Instrumentation.start()
+    sample_image = options['sample_image']
+    if comp_extract is None:
+        comp_extract = image_Points_Intensities(comp_image, **budget_arguments(options))
+    if options['func'] in POINT_SPACE_OBJECTIVES:
+        sample_extract = sample[0]
+    else:
+        sample_extract = image_Points_Intensities(sample_image, **budget_arguments(options))
+    refined = minimize(transport_cost_gradient, xopt, args=(comp_extract, sample_extract, sample_image.shape), 
+                       jac=True, method='L-BFGS-B', bounds=list(zip(options['lb'], options['ub'])), 
+                       options={'maxiter': options['refine_steps']})
+    Instrumentation.count('refine_evaluations', refined.nfev)
+    # compare on the objective the search's cost came from
+    if options['func'] in APPROXIMATE_OBJECTIVES:
+        cost = APPROXIMATE_OBJECTIVES[options['func']](np.atleast_2d(refined.x), comp_extract, *sample, 
+                                                       **exact_kwargs(options))[0]
+    else:
+        cost = options['func'](np.atleast_2d(refined.x), comp_extract, *sample, **objective_kwargs(options))[0]
+    Instrumentation.stop('refine', started)
+    print('Refinement cost {:} after {:} evaluations, search cost {:}'.format(cost, refined.nfev, fopt))
+    if cost < fopt:
+        Instrumentation.count('refinements_accepted')
+        return refined.x, cost, collisions, it
+    return result
+
+def pyramid_search(options, comp_image, sample, comp_extract=None, potentials=None):
+    """
+    Coarse to fine search for a single comparison image
+    The swarm first searches downsampled images, where every OT problem
+    is a fraction of the size, then each finer level is seeded around the
+    best position of the level before it, so only the last level is solved
+    at full resolution. Positions carry over between levels unchanged as
+    translations are proportions of the image size
+
+    Args:
+        options (dict): optimal_sample_transform options along with
+            pyramid (list of number): downsampling factors of the coarse
+                levels, coarsest first, e.g. [0.25, 0.5]
+            pyramid_maxiter (int): iterations of each level, including the
+                full resolution one (Default: maxiter // number of levels)
+            pyramid_fraction (number): proportion of each finer swarm seeded
+                around the previous level's best (Default: 0.5)
+            pyramid_spread (number): spread of the seeded particles as a
+                proportion of the bounds (Default: 0.05)
+        comp_image (image): original form
+        sample (tuple): sample arguments built by sample_argument
+        comp_extract, potentials: optional state of the full resolution
+            level, see pso_arguments
+    Returns:
+        custom_pso return values of the full resolution level with the
+            collisions and iterations of every level
+    """
+    levels = list(options['pyramid']) + [1]
+    maxiter = options.get('pyramid_maxiter') or max(1, options['maxiter'] // len(levels))
+    best = None
+    collisions = 0
+    iterations = 0
+    for factor in levels:
+        level_options = dict(options, maxiter=maxiter)
+        if factor == 1:
+            arguments = pso_arguments(level_options, comp_image, sample, comp_extract, potentials)
+        else:
+            level_options['sample_image'] = downsample_image(options['sample_image'], factor)
+            level_sample = sample_argument(options['func'], level_options['sample_image'], **budget_arguments(options))
+            arguments = pso_arguments(level_options, downsample_image(comp_image, factor), level_sample)
+        if best is not None:
+            arguments['inital_position'] = seeded_positions(best, arguments['lb'], arguments['ub'], options['swarmsize'], 
+                                                            options.get('pyramid_fraction', 0.5), 
+                                                            options.get('pyramid_spread', 0.05))
+        started = Instrumentation.start()
+        best, fopt, level_collisions, it = custom_pso(**arguments)
+        Instrumentation.stop('pyramid_{:g}'.format(factor), started)
+        report_cache(arguments)
+        print('Pyramid level {:g} finished after {:} iterations with cost {:}'.format(factor, it + 1, fopt))
+        collisions += level_collisions
+        iterations += it + 1
+    return full_result(arguments, (best, fopt, collisions, iterations - 1))
+
+def objective_kwargs(options):
+    """
+    Builds the keyword arguments selecting the objective's OT solver,
+    a new DualPotentials store is made for every search so that each
+    particle is warm started from its own previous solve
+
+    Args:
+        options (dict): optimal_sample_transform options along with
+            solver (string): one of OptimalTransport.SOLVERS (Default: 'emd')
+            reg (number): entropic regularization (Default: DEFAULT_REG)
+            n_projections (int): directions of the sliced objective (Default: 50)
+    Returns:
+        kwargs (dict): keyword arguments for the objective function
+    """
+    raster = {} if options['func'] in POINT_SPACE_OBJECTIVES else raster_arguments(options)
+    if options['func'] in APPROXIMATE_OBJECTIVES:
+        return dict(raster, n_projections=options.get('n_projections', 50))
+    solver = options.get('solver', 'emd')
+    if solver == 'emd':
+        return raster
+    potentials = DualPotentials() if solver in WARM_STARTED_SOLVERS else None
+    return dict(raster, solver=solver, reg=options.get('reg', DEFAULT_REG), potentials=potentials)
+
+def raster_arguments(options):
+    """
+    Builds the keyword arguments of objectives that warp the sample image,
+    the extraction budget and, for the composed warp, a buffer allocated
+    once per search that every evaluation warps the swarm into
+
+    Args:
+        options (dict): optimal_sample_transform options along with
+            warp (string): 'staged' warps each image four times like
+                apply_transformations, 'composed' warps once with the composed
+                affine, see apply_transformations_composed (Default: 'staged')
+    Returns:
+        kwargs (dict): keyword arguments for the objective function
+    """
+    kwargs = budget_arguments(options)
+    if options.get('warp', 'staged') == 'composed':
+        sample_image = options['sample_image']
+        kwargs['warp_buffer'] = np.empty((options['swarmsize'],) + sample_image.shape[:2], dtype=sample_image.dtype)
+    return kwargs
+
+def warp_swarm(set_x, image, warp_buffer=None):
+    """
+    Transforms the sample image for every particle
+
+    Args:
+        set_x (array-like (swarmsize, 7)): positions of every particle
+        image (image): sample image
+        warp_buffer (np array): optional preallocated stack, selects the
+            single composed warp, see raster_arguments
+    Returns:
+        images (np array (swarmsize, height, width)): transformed images
+    """
+    if warp_buffer is None:
+        return apply_transformations_batch(set_x, image)
+    return apply_transformations_composed_batch(set_x, image, warp_buffer)
+
+def budget_arguments(options):
+    """
+    Builds the keyword arguments of the point extraction budget
+
+    Args:
+        options (dict): optimal_sample_transform options along with
+            max_points (int): optional bound on the points of every extract
+            budget (string): one of ImageUtility.BUDGETS (Default: 'superpixels')
+    Returns:
+        kwargs (dict): keyword arguments for image_Points_Intensities,
+            empty when there is no budget
+    """
+    if not options.get('max_points'):
+        return {}
+    return dict(max_points=options['max_points'], budget=options.get('budget', 'superpixels'))
+
+def exact_kwargs(options):
+    """
+    Builds the keyword arguments of the exact EMD objective that costs of
+    approximate searches are compared on, with the same extraction budget
+    and warp as the search
+
+    Args:
+        options (dict): optimal_sample_transform options
+    Returns:
+        kwargs (dict): keyword arguments for the exact objective function
+    """
+    func = APPROXIMATE_OBJECTIVES.get(options['func'], options['func'])
+    return objective_kwargs(dict(options, func=func, solver='emd'))
+
+def rescore_exact(options, sample, results):
+    """
+    Replaces each candidate's cost by the exact EMD cost of its best position
+
+    Args:
+        options (dict): optimal_sample_transform options
+        sample (tuple): sample arguments built by sample_argument
+        results (list): custom_pso return values per candidate
+    Returns:
+        results (list): custom_pso return values with exact costs
+    """
+    rescored = []
+    for comp_image, (xopt, fopt, collisions, it) in zip(options['comp_set'], results):
+        # candidates dropped from a race stay dropped
+        if np.isfinite(fopt):
+            comp_extract = image_Points_Intensities(comp_image, **budget_arguments(options))
+            func = APPROXIMATE_OBJECTIVES.get(options['func'], options['func'])
+            fopt = func(np.atleast_2d(xopt), comp_extract, *sample, **exact_kwargs(options))[0]
+        rescored.append((xopt, fopt, collisions, it))
+    return rescored
+
+def pso_arguments(options, comp_image, sample, comp_extract=None, potentials=None):
+    """
+    Builds the custom_pso keyword arguments for a single comparison image
+
+    Args:
+        options (dict): optimal_sample_transform options
+        comp_image (image): original form
+        sample (tuple): sample arguments built by sample_argument
+        comp_extract ([point, weight]): optional precomputed extract of
+            comp_image, made with the options' extraction budget
+        potentials (DualPotentials): optional warm start store used instead
+            of a new one, so the dual potentials on comp_image's support
+            carry over from earlier samples
+    Returns:
+        arguments (dict): keyword arguments of custom_pso and pso_search
+    """
+    func = options['func']
+    rescore_func = APPROXIMATE_OBJECTIVES.get(func)
+    lower_bound, upper_bound = options['lb'], options['ub']
+    if options.get('cache_resolution'):
+        resolution = options['cache_resolution'] * (np.array(options['ub']) - np.array(options['lb']))
+        func = MemoizedObjective(func, resolution, options.get('cache_size', 4096))
+    if comp_extract is None:
+        comp_extract = image_Points_Intensities(comp_image, **budget_arguments(options))
+    kwargs = objective_kwargs(options)
+    if potentials is not None and 'potentials' in kwargs:
+        kwargs['potentials'] = potentials
+    sample_image = options['sample_image']
+    if options.get('solve_translation'):
+        sample_extract = sample[0] if options['func'] in POINT_SPACE_OBJECTIVES else image_Points_Intensities(sample_image)
+        func = TranslationSolvedObjective(func, comp_extract, sample_extract, sample_image.shape, lower_bound, upper_bound)
+        if rescore_func is not None:
+            rescore_func = TranslationSolvedObjective(rescore_func, comp_extract, sample_extract, sample_image.shape, 
+                                                      lower_bound, upper_bound)
+        lower_bound = list(np.array(lower_bound)[REDUCED_DIMENSIONS])
+        upper_bound = list(np.array(upper_bound)[REDUCED_DIMENSIONS])
+    inital_position = None
+    if options.get('seed_fraction'):
+        estimate = moment_alignment(comp_extract, image_Points_Intensities(sample_image), sample_image.shape, 
+                                    options['lb'], options['ub'])
+        if options.get('solve_translation'):
+            estimate = estimate[REDUCED_DIMENSIONS]
+        inital_position = seeded_positions(estimate, lower_bound, upper_bound, options['swarmsize'], 
+                                           options['seed_fraction'], options.get('seed_spread', 0.05))
+    return dict(func=func, lb=lower_bound, ub=upper_bound, 
+                args=(comp_extract, *sample), 
+                kwargs=kwargs,
+                swarmsize=options['swarmsize'], w=options['w'], 
+                c1=options['c1'], c2=options['c2'], maxiter=options['maxiter'], 
+                minstep=options['minstep'], minfunc=options['minfunc'],
+                debug=options['debug'], inertia_decay=options['inertia_decay'],
+                rescore_func=rescore_func,
+                rescore_k=options.get('rescore_top_k', 5),
+                rescore_kwargs=exact_kwargs(options) if rescore_func is not None else {},
+                prune=bool(options.get('prune_bound')) and options['func'] in PRUNING_OBJECTIVES 
+                      and not options.get('cache_resolution'),
+                patience=options.get('patience'), shrink=options.get('shrink', 1), 
+                min_swarmsize=options.get('min_swarmsize', 5),
+                inital_position=inital_position)
+
+def report_cache(arguments):
+    """
+    Prints the counters of a search's objective cache, if it has one
+
+    Args:
+        arguments (dict): keyword arguments built by pso_arguments
+    """
+    func = arguments['func']
+    if isinstance(func, TranslationSolvedObjective):
+        func = func.func
+    if isinstance(func, MemoizedObjective):
+        print(func.report())
+
+# the rotation, scale and shear dimensions searched when translation is solved
+REDUCED_DIMENSIONS = [0, 3, 4, 5, 6]
+
+class TranslationSolvedObjective:
+    """
+    Objective over the rotation, scale and shear dimensions only
+    Each position is completed with the translation that aligns the weighted
+    centroid of the transformed sample with the comparison's, which for the
+    squared euclidean OT cost is the optimal translation, so the swarm
+    searches 5 instead of 7 dimensions
+
+    Args:
+        func (function): objective over all seven dimensions
+        comp_extract ([point, weight]): comparison image extract
+        sample_extract ([point, weight]): sample image extract
+        shape (tuple): shape of the sample image
+        lb, ub (list): seven dimensional bounds, translations are clipped to them
+    """
+    def __init__(self, func, comp_extract, sample_extract, shape, lb=lb, ub=ub):
+        self.func = func
+        self.comp_centroid = weighted_moments(comp_extract)[0]
+        self.sample_centroid = weighted_moments(sample_extract)[0]
+        self.shape = shape
+        self.lb = lb
+        self.ub = ub
+
+    def full_position(self, set_x):
+        """
+        Args:
+            set_x (array-like (n, 5)): reduced positions
+
+        Returns:
+            set_x (np array (n, 7)): positions with their solved translation
+        """
+        set_x = np.atleast_2d(set_x)
+        full = np.zeros((len(set_x), len(self.lb)))
+        full[:, REDUCED_DIMENSIONS] = set_x
+        return centroid_translation(full, self.comp_centroid, self.sample_centroid, self.shape, self.lb, self.ub)
+
+    def __call__(self, set_x, *args, **kwargs):
+        return self.func(self.full_position(set_x), *args, **kwargs)
+
+def full_result(arguments, result):
+    """
+    Completes the position of a search's result to all seven dimensions
+    when the search solved translation
+
+    Args:
+        arguments (dict): keyword arguments built by pso_arguments
+        result (tuple): custom_pso return values
+
+    Returns:
+        result (tuple): custom_pso return values with a seven dimensional xopt
+    """
+    if not isinstance(arguments['func'], TranslationSolvedObjective):
+        return result
+    xopt, fopt, collisions, it = result
+    return arguments['func'].full_position(xopt)[0], fopt, collisions, it
+
+def race_candidates(options, sample):
+    """
+    Successive halving race between the comparison candidates
+    Every remaining candidate's search is advanced race_rung iterations,
+    then all but the best 1/race_eta of them are dropped, until only
+    race_finalists remain. The finalists run until their own stopping
+    criterion so the ranking only compares fully converged swarms
+
+    Args:
+        options (dict): optimal_sample_transform options along with
+            race_rung (int): iterations per rung
+            race_eta (number): fraction 1/eta of candidates kept per rung
+                (Default: 2)
+            race_finalists (int): number of candidates run to completion
+                (Default: 2)
+        sample (tuple): sample arguments built by sample_argument
+    Returns:
+        results (list): custom_pso return values in comparison set order,
+            dropped candidates keep their last position with a cost of infinity
+    """
+    eta = options.get('race_eta', 2)
+    finalists = options.get('race_finalists', 2)
+    arguments = [pso_arguments(options, comp_image, sample) for comp_image in options['comp_set']]
+    searches = [pso_search(**candidate) for candidate in arguments]
+    results = [None] * len(searches)
+    converged = [False] * len(searches)
+    remaining = list(range(len(searches)))
+    
+    while len(remaining) > finalists:
+        for i in remaining:
+            for step in range(options['race_rung']):
+                if converged[i]:
+                    break
+                try:
+                    results[i] = next(searches[i])
+                except StopIteration as stop:
+                    results[i] = stop.value
+                    converged[i] = True
+        # rank by best cost so far and keep the leaders
+        remaining.sort(key=lambda i: results[i][1])
+        keep = max(finalists, int(np.ceil(len(remaining) / eta)))
+        for i in remaining[keep:]:
+            xopt, fopt, collisions, it = results[i]
+            results[i] = (xopt, float('infinity'), collisions, it)
+            print('Race dropped candidate {:} after {:} iterations with cost {:}'.format(i, it + 1, fopt))
+        remaining = remaining[:keep]
+    
+    for i in remaining:
+        if not converged[i]:
+            results[i] = run_search(searches[i])
+    for candidate in arguments:
+        report_cache(candidate)
+    results = [full_result(candidate, result) for candidate, result in zip(arguments, results)]
+    if options.get('refine_steps'):
+        # dropped candidates have an infinite cost and are left as they are
+        results = [refine_result(options, comp_image, sample, result, candidate['args'][0]) 
+                   for comp_image, candidate, result in zip(options['comp_set'], arguments, results)]
+    return results
+
+# options fit_candidate supports that fit_candidates_multi_swarm does not
+MULTI_SWARM_UNSUPPORTED = ('solve_translation', 'cache_resolution', 'pyramid', 'debug')
+
+def fit_candidates_multi_swarm(options, sample, comp_extracts=None, potentials=None):
+    """
+    Fits the sample to every comparison image at once with multi_swarm_pso,
+    the swarms of all candidates are updated together and their positions
+    evaluated by a single objective_function_swarms call per iteration
+    Supports the EMD objectives (objective_function_batch and
+    objective_function_points) along with the OT solver, the extraction
+    budget, the composed warp, moment seeding, pruning, patience and
+    refinement, the options of MULTI_SWARM_UNSUPPORTED and shrinking are not
+
+    Args:
+        options (dict): optimal_sample_transform options
+        sample (tuple): sample arguments built by sample_argument
+        comp_extracts (list): optional precomputed extract per candidate,
+            made with the options' extraction budget
+        potentials (list of DualPotentials): optional warm start store per
+            candidate used instead of new ones, see pso_arguments
+    Returns:
+        results (list): custom_pso return values in comparison set order
+    """
+    assert options['func'] in PRUNING_OBJECTIVES, 'multi_swarm supports objective_function_batch and objective_function_points'
+    unsupported = [key for key in MULTI_SWARM_UNSUPPORTED if options.get(key)]
+    if options.get('shrink', 1) < 1:
+        unsupported.append('shrink')
+    assert not unsupported, 'multi_swarm does not support {}'.format(', '.join(unsupported))
+    comp_set = options['comp_set']
+    sample_image = options['sample_image']
+    if comp_extracts is None:
+        comp_extracts = [image_Points_Intensities(comp_image, **budget_arguments(options)) for comp_image in comp_set]
+    kwargs = dict(objective=options['func'], solver=options.get('solver', 'emd'), reg=options.get('reg', DEFAULT_REG))
+    if kwargs['solver'] in WARM_STARTED_SOLVERS:
+        kwargs['potentials'] = potentials if potentials is not None else [DualPotentials() for comp_image in comp_set]
+    if options['func'] not in POINT_SPACE_OBJECTIVES:
+        kwargs.update(raster_arguments(dict(options, swarmsize=len(comp_set) * options['swarmsize'])))
+    inital_position = None
+    if options.get('seed_fraction'):
+        sample_extract = image_Points_Intensities(sample_image)
+        inital_position = np.stack([seeded_positions(moment_alignment(comp_extract, sample_extract, sample_image.shape, 
+                                                                      options['lb'], options['ub']), 
+                                                     options['lb'], options['ub'], options['swarmsize'], 
+                                                     options['seed_fraction'], options.get('seed_spread', 0.05)) 
+                                    for comp_extract in comp_extracts])
+    results = multi_swarm_pso(objective_function_swarms, options['lb'], options['ub'], len(comp_set), 
+                              args=(comp_extracts, *sample), kwargs=kwargs, 
+                              swarmsize=options['swarmsize'], w=options['w'], 
+                              c1=options['c1'], c2=options['c2'], maxiter=options['maxiter'], 
+                              minstep=options['minstep'], minfunc=options['minfunc'], 
+                              inertia_decay=options['inertia_decay'], inital_position=inital_position, 
+                              prune=bool(options.get('prune_bound')), patience=options.get('patience'))
+    if options.get('refine_steps'):
+        results = [refine_result(options, comp_image, sample, result, comp_extract) 
+                   for comp_image, comp_extract, result in zip(comp_set, comp_extracts, results)]
+    return results
+
+def fit_candidate_quietly(options, comp_image, sample, seed=None, instrument=False, comp_extract=None):
+    """
+    fit_candidate for worker processes, stdout is only kept when debugging
+
+    Args:
+        instrument (boolean): record the worker's stages, see Instrumentation
+        comp_extract ([point, weight]): optional precomputed extract of comp_image
+
+    Returns:
+        result: fit_candidate return values
+        stages (dict): Instrumentation snapshot of the fit, None if not instrumented
+    """
+    Instrumentation.enable(instrument)
+    Instrumentation.reset()
+    if options['debug']:
+        result = fit_candidate(options, comp_image, sample, seed, comp_extract)
+    else:
+        with suppress_stdout():
+            result = fit_candidate(options, comp_image, sample, seed, comp_extract)
+    return result, Instrumentation.snapshot() if instrument else None
+
+def fit_candidates_parallel(executor, options, sample):
+    """
+    Spreads the comparison candidates over an executor's workers
+
+    Args:
+        executor (concurrent.futures.Executor): pool to submit to
+        options (dict): optimal_sample_transform options
+        sample (tuple): sample arguments built by sample_argument
+    Returns:
+        results (list): fit_candidate return values in comparison set order
+    """
+    return [candidate_result(future) for future in submit_candidates(executor, options, sample)]
+
+def submit_candidates(executor, options, sample, comp_extracts=None):
+    """
+    Submits the fit of every comparison candidate to an executor without
+    waiting for them, so the fits of several samples can be in flight at once
+
+    Args:
+        executor (concurrent.futures.Executor): pool to submit to
+        options (dict): optimal_sample_transform options
+        sample (tuple): sample arguments built by sample_argument
+        comp_extracts (list): optional precomputed extract per candidate
+    Returns:
+        futures (list): fit_candidate_quietly futures in comparison set order,
+            see candidate_result
+    """
+    # the executor itself cannot be sent to its workers
+    options = {key: value for key, value in options.items() if key != 'executor'}
+    # workers would otherwise share the random state they were forked with
+    seeds = np.random.randint(2**31, size=len(options['comp_set']))
+    if comp_extracts is None:
+        comp_extracts = [None] * len(options['comp_set'])
+    return [executor.submit(fit_candidate_quietly, options, comp_image, sample, seed, Instrumentation.ENABLED, extract)
+            for comp_image, seed, extract in zip(options['comp_set'], seeds, comp_extracts)]
+
+def candidate_result(future):
+    """
+    Waits for a fit_candidate_quietly future, the worker's records are its
+    own so they are folded into this process' instrumentation
+
+    Returns:
+        result: fit_candidate return values
+    """
+    result, stages = future.result()
+    if stages is not None:
+        Instrumentation.merge(stages)
+    return result
+
+def sample_argument(func, sample_image, max_points=None, budget='superpixels'):
+    """
+    Builds the sample arguments an objective function expects after the
+    comparison extract: point space objectives take the sample extract
+    (computed once here) and the image shape, all others take the image
+
+    Args:
+        func (function): objective function handed to custom_pso
+        sample_image (image): variation
+        max_points, budget: extraction budget of the sample extract,
+            see ImageUtility.budget_support
+
+    Returns:
+        sample (tuple): trailing arguments for func
+    """
+    if func in POINT_SPACE_OBJECTIVES:
+        return (image_Points_Intensities(sample_image, max_points, budget), sample_image.shape)
+    return (sample_image,)
+
+def objective_mode_benchmark(comp_set, sample_images, answers, options):
+    """
+    Compares the raster objective against the point space objective
+    by running optimal_sample_transform with each on the same samples
+
+    Args:
+        comp_set (list of images): original forms
+        sample_images (list of images): variations to classify
+        answers (list of numbers): true candidate of each variation
+        options (dict): optimal_sample_transform options, 'func' is replaced
+    Returns:
+        results (dict): per mode time and accuracy, plus the rate at which
+            both modes classified a sample identically
+    """
+    modes = {'raster': objective_function_batch, 'points': objective_function_points}
+    results = {mode: {'time': 0, 'correct': 0, 'classified': []} for mode in modes}
+    for sample_image, answer in zip(sample_images, answers):
+        for mode, func in modes.items():
+            mode_options = dict(options, comp_set=comp_set, sample_image=sample_image, func=func)
+            # both modes start from the same random swarm
+            state = np.random.get_state()
+            start = time.time()
+            with suppress_stdout():
+                best_images, min_answer, xopt = optimal_sample_transform(mode_options)
+            results[mode]['time'] += time.time() - start
+            results[mode]['correct'] += int(min_answer == answer)
+            results[mode]['classified'].append(min_answer)
+            np.random.set_state(state)
+    
+    agreement = np.mean(np.equal(results['raster']['classified'], results['points']['classified']))
+    for mode in modes:
+        print('{} objective took {} seconds with {}% accuracy'.format(
+            mode, results[mode]['time'], 100 * results[mode]['correct'] / len(answers)))
+    print('modes agreed on {}% of samples'.format(100 * agreement))
+    results['agreement'] = agreement
+    return results
 
 def optimal_sample_transform_test(comp_set, sample_image):
     """
@@ -141,6 +843,183 @@ def objective_function_custom(set_x, comp_extract, image):
     for x in set_x:
         cost_matrix.append(objective_function(x, comp_extract, image))
     return cost_matrix
+
+def objective_function_batch(set_x, comp_extract, image, solver='emd', reg=DEFAULT_REG, potentials=None, 
+                             max_points=None, budget='superpixels', warp_buffer=None, pbest_cost=None):
+    """
+    Batched equivalent of objective_function_custom: the whole swarm is
+    warped in one batched call and every point/weight set is extracted
+    at once, leaving only the OT solve per particle
+
+    Args:
+    =====
+    set_x (array-like (swarmsize, 7)): positions of every particle
+    comp_extract ([point, weight]): comparison image extract
+    image (image): sample image
+    solver, reg, potentials: OT solver selection, see POT_Parameterized
+    max_points, budget: extraction budget, see ImageUtility.budget_support
+    warp_buffer (np array): optional buffer of the composed warp, see warp_swarm
+    pbest_cost (np array): optional personal best cost of every particle,
+        solves whose lower bound exceeds it are skipped, see custom_pso's prune
+
+    Returns:
+    ========
+    cost_matrix (np array): cost of each particle's transformation
+    """
+    a, SA = comp_extract
+    cost_matrix = []
+    started = Instrumentation.start()
+    warped = warp_swarm(set_x, image, warp_buffer)
+    Instrumentation.stop('warp', started)
+    started = Instrumentation.start()
+    extracts = image_Points_Intensities_batch(warped, max_points, budget)
+    Instrumentation.stop('threshold', started)
+    for particle, (b, DB) in enumerate(extracts):
+        a, b, cost, total_time, transport_Plan = POT_Parameterized(a, b, SA, DB, image.shape, solver, 
+                                                                   reg, potentials, particle, 
+                                                                   prune_bound(pbest_cost, particle))
+        cost_matrix.append(cost)
+    return np.array(cost_matrix)
+
+def objective_function_points(set_x, comp_extract, sample_extract, shape, solver='emd', reg=DEFAULT_REG, potentials=None, 
+                              pbest_cost=None):
+    """
+    Point space alternative to objective_function_batch: the sample is
+    extracted once and each particle's transformation is applied directly
+    to the extracted points, so no image is warped or re-thresholded
+
+    Args:
+    =====
+    set_x (array-like (swarmsize, 7)): positions of every particle
+    comp_extract ([point, weight]): comparison image extract
+    sample_extract ([point, weight]): sample image extract
+    shape (tuple): shape of the sample image
+    solver, reg, potentials: OT solver selection, see POT_Parameterized
+    pbest_cost (np array): optional personal best cost of every particle,
+        solves whose lower bound exceeds it are skipped, see custom_pso's prune
+
+    Returns:
+    ========
+    cost_matrix (np array): cost of each particle's transformation
+    """
+    a, SA = comp_extract
+    b, DB = sample_extract
+    cost_matrix = []
+    started = Instrumentation.start()
+    transformed = transform_points_batch(set_x, b, shape)
+    Instrumentation.stop('transform_points', started)
+    for particle, points in enumerate(transformed):
+        a, points, cost, total_time, transport_Plan = POT_Parameterized(a, points, SA, DB, None, solver, 
+                                                                        reg, potentials, particle, 
+                                                                        prune_bound(pbest_cost, particle))
+        cost_matrix.append(cost)
+    return np.array(cost_matrix)
+
+def objective_function_sliced(set_x, comp_extract, image, n_projections=50, max_points=None, budget='superpixels', 
+                              warp_buffer=None):
+    """
+    Fast approximation of objective_function_batch that ranks particles by
+    the sliced Wasserstein cost instead of solving each OT problem exactly,
+    a sort per projection replaces the network simplex
+
+    Args:
+    =====
+    set_x (array-like (swarmsize, 7)): positions of every particle
+    comp_extract ([point, weight]): comparison image extract
+    image (image): sample image
+    n_projections (int): directions of the projection bank
+    max_points, budget: extraction budget, see ImageUtility.budget_support
+    warp_buffer (np array): optional buffer of the composed warp, see warp_swarm
+
+    Returns:
+    ========
+    cost_matrix (np array): sliced cost of each particle's transformation
+    """
+    a, SA = comp_extract
+    cost_matrix = []
+    started = Instrumentation.start()
+    warped = warp_swarm(set_x, image, warp_buffer)
+    Instrumentation.stop('warp', started)
+    started = Instrumentation.start()
+    extracts = image_Points_Intensities_batch(warped, max_points, budget)
+    Instrumentation.stop('threshold', started)
+    started = Instrumentation.start()
+    for b, DB in extracts:
+        cost_matrix.append(sliced_Wasserstein(a, b, SA, DB, image.shape, n_projections))
+    Instrumentation.stop('sliced', started)
+    return np.array(cost_matrix)
+
+def prune_bound(pbest_cost, particle):
+    """
+    Returns:
+        prune_above (number): the personal best a particle's solve has to
+            beat, None when the swarm does not prune
+    """
+    return None if pbest_cost is None else pbest_cost[particle]
+
+def objective_function_swarms(X, comp_extracts, *sample, classes=None, objective=objective_function_batch, 
+                              solver='emd', reg=DEFAULT_REG, potentials=None, max_points=None, budget='superpixels', 
+                              warp_buffer=None, pbest_cost=None):
+    """
+    Evaluates the swarms of several comparison images in one call: the
+    sample is warped (or its points transformed) for every particle of every
+    swarm in a single batch, leaving only the OT solve per particle
+
+    Args:
+    =====
+    X (array-like (swarms, swarmsize, 7)): positions of every swarm's particles
+    comp_extracts (list of [point, weight]): extract of every comparison image
+    sample: sample arguments of objective, see sample_argument
+    classes (array-like): comparison image index of each swarm in X
+        (Default: None, one swarm per comparison image)
+    objective (function): objective_function_batch or objective_function_points
+    solver, reg: OT solver selection, see POT_Parameterized
+    potentials (list of DualPotentials): optional warm start store per
+        comparison image, keyed by each particle's index within its swarm
+    max_points, budget, warp_buffer: see objective_function_batch
+    pbest_cost (np array (swarms, swarmsize)): optional personal bests, see
+        objective_function_batch
+
+    Returns:
+    ========
+    cost_matrix (np array (swarms, swarmsize)): cost of each particle's transformation
+    """
+    X = np.asarray(X)
+    swarms, swarmsize, dimensions = X.shape
+    classes = range(swarms) if classes is None else classes
+    flat = X.reshape(-1, dimensions)
+    if pbest_cost is not None:
+        pbest_cost = np.ravel(pbest_cost)
+    started = Instrumentation.start()
+    if objective in POINT_SPACE_OBJECTIVES:
+        (b, DB), shape = sample
+        extracts = [(points, DB) for points in transform_points_batch(flat, b, shape)]
+        shape = None
+        Instrumentation.stop('transform_points', started)
+    else:
+        image, = sample
+        shape = image.shape
+        warped = warp_swarm(flat, image, warp_buffer)
+        Instrumentation.stop('warp', started)
+        started = Instrumentation.start()
+        extracts = image_Points_Intensities_batch(warped, max_points, budget)
+        Instrumentation.stop('threshold', started)
+    cost_matrix = np.empty(len(flat))
+    for particle, (b, DB) in enumerate(extracts):
+        swarm = classes[particle // swarmsize]
+        a, SA = comp_extracts[swarm]
+        store = potentials[swarm] if potentials is not None else None
+        cost_matrix[particle] = POT_Parameterized(a, b, SA, DB, shape, solver, reg, store, particle % swarmsize, 
+                                                  prune_bound(pbest_cost, particle))[2]
+    return cost_matrix.reshape(swarms, swarmsize)
+
+POINT_SPACE_OBJECTIVES = (objective_function_points,)
+
+# objectives that can skip solves bounded above a particle's personal best
+PRUNING_OBJECTIVES = (objective_function_batch, objective_function_points)
+
+# approximate objectives and the exact objective their finalists are re-scored with
+APPROXIMATE_OBJECTIVES = {objective_function_sliced: objective_function_batch}
     
 def objective_function(x, comp_extract, image):
     """
@@ -159,8 +1038,12 @@ def objective_function(x, comp_extract, image):
     cost (number): the minimum cost between the transformed image
         and the set of images
     """
+    started = Instrumentation.start()
     image = apply_transformations(x, image)
+    Instrumentation.stop('warp', started)
+    started = Instrumentation.start()
     b, DB = image_Points_Intensities(image)
+    Instrumentation.stop('threshold', started)
     a, SA = comp_extract
-    a, b, cost, total_time, transport_Plan = POT_Parameterized(a, b, SA, DB)
+    a, b, cost, total_time, transport_Plan = POT_Parameterized(a, b, SA, DB, image.shape)
     return cost
\ No newline at end of file
@@ -1,5 +1,12 @@
 import os
+import json
+import numpy as np
 import pandas as pd
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 
 def write_To_Excel(rows, cols, sheetName, path):
@@ -25,3 +32,79 @@ def write_To_Excel(rows, cols, sheetName, path):
             print(e)
             print('Error writing to excel file')
             df.to_excel(path, sheet_name=sheetName, index=False)
+
+
+def to_Json(value):
+    """
+    Converts numpy values that json cannot serialize
+    """
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    raise TypeError('Cannot serialize {}'.format(type(value)))
+
+
+def append_To_Log(rows, cols, path):
+    """
+    Appends a list of rows to a line oriented (json lines) results log
+    each row is a single locked write to the end of the file, so appends
+    cost the same however large the log grows and many processes can
+    append to the same log at once
+    """
+    lines = ''.join(json.dumps(dict(zip(cols, row)), default=to_Json) + '\n' for row in rows)
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            f.write(lines)
+            f.flush()
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def read_Log(path):
+    """
+    Reads a results log written by append_To_Log into a dataframe
+    a partially written last line (from an interrupted run) is skipped
+    """
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                print('Skipping incomplete line in {}'.format(path))
+    return pd.DataFrame(records)
+
+
+def export_Log_To_Excel(log_path, path, sheetName='results'):
+    """
+    Writes a results log to an excel file with a given sheet name
+    along with a summary sheet of the accuracy and time per font
+    and, for instrumented runs, a stages sheet with a row of stage
+    counters and timing totals per trial (histogram buckets stay in the log)
+    the excel file is replaced, the log remains the source of truth
+    """
+    df = read_Log(log_path)
+    stages = None
+    if 'stages' in df.columns:
+        instrumented = df[df['stages'].notna()]
+        stages = pd.json_normalize(instrumented['stages'].tolist())
+        stages = stages[[col for col in stages.columns if '.buckets.' not in col]]
+        keys = [col for col in ('case', 'trial') if col in df.columns]
+        stages = pd.concat([instrumented[keys].reset_index(drop=True), stages], axis=1)
+        df = df.drop(columns='stages')
+    with pd.ExcelWriter(path, engine='openpyxl') as writer:
+        df.to_excel(writer, sheet_name=sheetName, index=False)
+        if stages is not None and len(stages):
+            stages.to_excel(writer, sheet_name='stages', index=False)
+        if {'font', 'answer', 'classified_as'}.issubset(df.columns):
+            summary = df.assign(correct=df['answer'] == df['classified_as']).groupby('font').agg(
+                trials=('correct', 'size'), accuracy=('correct', 'mean'))
+            if 'time' in df.columns:
+                summary['mean_time'] = df.groupby('font')['time'].mean()
+            summary.reset_index().to_excel(writer, sheet_name='summary', index=False)